@@ -0,0 +1,77 @@
+"""
+Maintenance commands for Sistema Gestione Ferie e Permessi.
+
+Run from the backend directory, with the same .env as the API:
+    python manage.py rebuild-yearly-stats [--verify]
+    python manage.py rollover-vacation YEAR [--max-days 20]
+    python manage.py import-employees FILE.csv
+"""
+
+import asyncio
+import json
+from pathlib import Path
+
+import typer
+
+import server
+
+cli = typer.Typer()
+
+
+@cli.callback()
+def main():
+    """Comandi di manutenzione del Sistema Gestione Ferie"""
+
+
+@cli.command("rebuild-yearly-stats")
+def rebuild_yearly_stats(
+    verify: bool = typer.Option(False, "--verify", help="Solo verifica: riporta le differenze senza correggerle")
+):
+    """Recompute yearly_stats from the requests collection and report drift"""
+    report = asyncio.run(server.rebuild_yearly_stats(write=not verify))
+
+    for item in report["drift"]:
+        typer.echo(json.dumps(item))
+    action = "corrected" if report["corrected"] else "found"
+    typer.echo(f"Checked {report['checked']} user/year pairs, drift {action} in {len(report['drift'])}")
+
+    if verify and report["drift"]:
+        raise typer.Exit(code=1)
+
+
+@cli.command("rollover-vacation")
+def rollover_vacation(
+    year: int = typer.Argument(..., help="Anno per cui creare le ferie"),
+    max_days: int = typer.Option(20, "--max-days", min=0, max=50, help="Giorni ferie massimi per dipendente"),
+    batch_size: int = typer.Option(1000, "--batch-size", min=1, help="Dipendenti per bulk write")
+):
+    """Create every active employee's vacation allowance for a year"""
+    def show_progress(done: int, total: int):
+        typer.echo(f"{done}/{total} employees processed")
+
+    result = asyncio.run(server.rollover_vacation_allowances(year, max_days, batch_size, progress=show_progress))
+    typer.echo(f"Year {result['year']}: {result['created']} allowances created, {result['skipped']} already present")
+
+
+@cli.command("import-employees")
+def import_employees(
+    csv_file: Path = typer.Argument(..., exists=True, dir_okay=False, help="CSV con colonne username, email e password (opzionale)")
+):
+    """Create employees in bulk from a CSV file and queue their credential emails"""
+    try:
+        rows = server.read_employee_csv(csv_file.read_bytes())
+    except ValueError as e:
+        typer.echo(str(e), err=True)
+        raise typer.Exit(code=1)
+
+    report = asyncio.run(server.import_employees(rows))
+    for item in report["errors"]:
+        typer.echo(json.dumps(item, ensure_ascii=False))
+    typer.echo(f"{report['created']} employees created, {len(report['errors'])} rows rejected")
+
+    if report["errors"]:
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    cli()
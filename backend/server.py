@@ -1,35 +1,267 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, BackgroundTasks, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, Request, Response, UploadFile, File, status
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, InsertOne, ReturnDocument, UpdateOne, monitoring
+from pymongo.collation import Collation, CollationStrength
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, EmailStr, validator
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, EmailStr, ValidationError, validator
+from typing import List, Optional, Dict, Any, Callable, Tuple, Iterable
 import uuid
+import secrets
 from datetime import datetime, timedelta, date, time
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import jwt
 import hashlib
+import re
+import base64
+import csv
+import io
+import json
 from passlib.context import CryptContext
 import asyncio
+from collections import OrderedDict
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+import threading
+import weakref
+from work_calendar import working_days_between
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# ===== REQUEST METRICS =====
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+class Histogram:
+    """Cumulative histogram per label values, rendered in Prometheus text format.
+    
+    Observations come from the event loop and from Motor's executor threads,
+    so updates are serialized with a lock.
+    """
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...], buckets: Tuple[float, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # Bucket counts, then sum and count
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {labels: list(series) for labels, series in self._series.items()}
+        for labels, series in sorted(snapshot.items()):
+            label_text = ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(self.label_names, labels))
+            prefix = label_text + "," if label_text else ""
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{label_text}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{label_text}}} {series[-1]}")
+        return lines
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_CALL_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "Time until the response headers are sent",
+    ("method", "route", "status"), LATENCY_BUCKETS
+)
+http_request_db_calls = Histogram(
+    "http_request_db_calls", "MongoDB commands issued per request", ("method", "route"), DB_CALL_BUCKETS
+)
+http_request_db_duration = Histogram(
+    "http_request_db_duration_seconds", "MongoDB time per request", ("method", "route"), LATENCY_BUCKETS
+)
+mongodb_command_duration = Histogram(
+    "mongodb_command_duration_seconds", "MongoDB command round trips", ("command",), LATENCY_BUCKETS
+)
+
+class DbCallStats:
+    """MongoDB commands issued while serving one HTTP request"""
+    __slots__ = ("calls", "seconds", "_lock")
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self.calls += 1
+            self.seconds += seconds
+
+# Stats of the request being served; Motor copies the context into its executor threads
+request_db_stats: ContextVar[Optional[DbCallStats]] = ContextVar("request_db_stats", default=None)
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Time every MongoDB command and charge it to the current HTTP request"""
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    def _record(self, event):
+        seconds = event.duration_micros / 1_000_000
+        mongodb_command_duration.observe((event.command_name,), seconds)
+        stats = request_db_stats.get()
+        if stats is not None:
+            stats.add(seconds)
+
+class RequestMetricsMiddleware:
+    """ASGI middleware recording latency and DB usage per route.
+    
+    Timings stop when the response headers are sent, so streamed responses
+    (exports, event stream) measure their time to first byte; the same
+    figures are returned in a Server-Timing header.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        stats = DbCallStats()
+        token = request_db_stats.set(stats)
+        started_at = monotonic()
+        
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                elapsed = monotonic() - started_at
+                route = scope.get("route")
+                route_path = route.path if route is not None else "unmatched"
+                method = scope["method"]
+                http_request_duration.observe((method, route_path, str(message["status"])), elapsed)
+                http_request_db_calls.observe((method, route_path), stats.calls)
+                http_request_db_duration.observe((method, route_path), stats.seconds)
+                
+                server_timing = f'db;desc="{stats.calls} calls";dur={stats.seconds * 1000:.1f}, app;dur={elapsed * 1000:.1f}'
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", server_timing.encode())]
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_db_stats.reset(token)
+
+# Optional bearer token protecting GET /metrics
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandListener()])
 db = client[os.environ['DB_NAME']]
 
+# Emails compare case-insensitively (Mario@x.it == mario@x.it)
+EMAIL_COLLATION = Collation(locale="en", strength=CollationStrength.SECONDARY)
+
+# Longest absence, in calendar days, the absence calendar can find from its start date.
+# Ferie span at most 27 days (15 working days) and permessi one; only sick leaves
+# can be longer, and those are looked up through their own partial index
+CALENDAR_SHORT_ABSENCE_DAYS = 31
+
+# Indexes backing every hot query, created idempotently at startup
+MONGO_INDEXES = {
+    "users": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("username", ASCENDING)], unique=True),
+        IndexModel([("email", ASCENDING)]),
+        # Case-insensitive email lookups (EMAIL_COLLATION)
+        IndexModel([("email", ASCENDING)], name="email_ci",
+                   collation={"locale": "en", "strength": CollationStrength.SECONDARY}),
+        IndexModel([("role", ASCENDING)]),
+    ],
+    "requests": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        # Admin listing: keyset pagination on (created_at, id)
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)]),
+        # Employee listing
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)]),
+        # Per-user stats and used vacation days, by the years the leave falls in
+        IndexModel([("user_id", ASCENDING), ("status", ASCENDING), ("days_by_year.year", ASCENDING)]),
+        # Dashboard pending counters
+        IndexModel([("status", ASCENDING), ("type", ASCENDING)]),
+        # Absence calendar: short absences starting shortly before or inside the window...
+        IndexModel([("absence_start", ASCENDING), ("absence_end", ASCENDING)]),
+        # ...and the few long sick leaves, by end date
+        IndexModel(
+            [("absence_end", ASCENDING), ("absence_start", ASCENDING)], name="long_absence_end",
+            partialFilterExpression={"sick_days": {"$gt": CALENDAR_SHORT_ABSENCE_DAYS}}
+        ),
+        # Overlap check against the employee's own requests
+        IndexModel([("user_id", ASCENDING), ("absence_end", ASCENDING), ("absence_start", ASCENDING)]),
+    ],
+    "absence_headcount": [
+        IndexModel([("day", ASCENDING)], unique=True),
+    ],
+    "vacation_allowances": [
+        IndexModel([("user_id", ASCENDING), ("year", ASCENDING)], unique=True),
+    ],
+    "vacation_ledger": [
+        IndexModel([("user_id", ASCENDING), ("year", ASCENDING)]),
+        IndexModel([("request_id", ASCENDING)]),
+    ],
+    "yearly_stats": [
+        IndexModel([("user_id", ASCENDING), ("year", ASCENDING)], unique=True),
+    ],
+    "email_outbox": [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel(
+            [("dedup_key", ASCENDING)], unique=True,
+            partialFilterExpression={"dedup_key": {"$type": "string"}}
+        ),
+        IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)]),
+        IndexModel([("claim_id", ASCENDING)]),
+    ],
+}
+
+# Indexes created by earlier versions and no longer used, dropped at startup
+RETIRED_INDEXES = {
+    # Replaced by (absence_start, absence_end) and long_absence_end for the calendar query
+    "requests": ["absence_end_1_absence_start_1"],
+}
+
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
 
+# bcrypt is CPU bound and releases the GIL, so it runs in a bounded thread pool
+# instead of blocking the event loop
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 4))
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+
+# Employees allowed off on the same day before new vacation requests are flagged (0 = no limit)
+MAX_CONCURRENT_ABSENCES = int(os.environ.get('MAX_CONCURRENT_ABSENCES', 0))
+
 # JWT Configuration
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 JWT_ALGORITHM = "HS256"
@@ -40,18 +272,138 @@ app = FastAPI(title="Sistema Gestione Ferie e Permessi", version="1.0.0")
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+# Fields stored on requests for indexed queries and bookkeeping, not returned by GET /api/requests...
+INTERNAL_REQUEST_FIELDS = (
+    "absence_start", "absence_end", "working_days", "days_by_year", "coverage_conflicts", "response_id"
+)
+# ...unless named in its fields parameter
+OPTIONAL_REQUEST_FIELDS = {"working_days", "coverage_conflicts"}
+
+# Maximum page size for GET /api/requests
+REQUESTS_PAGE_MAX_SIZE = 1000
+
+# Rows accepted by a single employee CSV import
+EMPLOYEE_IMPORT_MAX_ROWS = 5000
+
+# Requests accepted by a single bulk approve/reject call
+BULK_RESPONSE_MAX_REQUESTS = 1000
+
+# Widest window accepted by the absence calendar
+CALENDAR_MAX_WINDOW_DAYS = 366
+
+# Documents fetched per cursor batch by the streaming exports
+EXPORT_BATCH_SIZE = 1000
+
+REQUEST_EXPORT_COLUMNS = [
+    "id", "user_id", "username", "user_email", "type", "status",
+    "start_date", "end_date", "permit_date", "start_time", "end_time",
+    "sick_start_date", "sick_days", "protocol_code", "admin_notes", "created_at", "updated_at"
+]
+ALLOWANCE_EXPORT_COLUMNS = [
+    "user_id", "username", "email", "year", "max_days", "used_days", "carried_over_days", "remaining_days"
+]
+
 # Email Configuration
 class EmailSettings:
     def __init__(self):
-        self.smtp_server = "smtp.gmail.com"
-        self.smtp_port = 587
-        self.smtp_use_tls = True
+        self.smtp_server = os.environ.get('SMTP_SERVER', "smtp.gmail.com")
+        self.smtp_port = int(os.environ.get('SMTP_PORT', 587))
+        self.smtp_use_tls = os.environ.get('SMTP_USE_TLS', 'true').lower() == 'true'
+        self.smtp_timeout = 30
         self.admin_email = os.environ.get('ADMIN_EMAIL', '')  # To be configured manually
         self.admin_password = os.environ.get('ADMIN_APP_PASSWORD', '')  # Gmail App Password
         self.from_name = "Sistema Gestione Ferie"
 
 email_settings = EmailSettings()
 
+class SMTPMailer:
+    """Send emails over a single persistent, authenticated SMTP connection.
+
+    smtplib is blocking and not thread safe, so the connection is owned by a
+    dedicated single-thread executor and the event loop only awaits it.
+    """
+    def __init__(self, settings: EmailSettings):
+        self.settings = settings
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="smtp")
+        self._server: Optional[smtplib.SMTP] = None
+
+    def _connect(self) -> smtplib.SMTP:
+        server = smtplib.SMTP(self.settings.smtp_server, self.settings.smtp_port, timeout=self.settings.smtp_timeout)
+        try:
+            server.ehlo()
+            if self.settings.smtp_use_tls:
+                server.starttls()
+                server.ehlo()
+            if self.settings.admin_password and server.has_extn('auth'):
+                server.login(self.settings.admin_email, self.settings.admin_password)
+        except Exception:
+            server.close()
+            raise
+        return server
+
+    def _disconnect(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                # quit() leaves the socket open when the QUIT exchange itself fails
+                self._server.close()
+            self._server = None
+
+    def _send(self, msg: MIMEMultipart):
+        # Reuse the open session; if the server dropped it, reconnect once and retry.
+        # Any failure closes the session, so the next message never inherits a broken one
+        for attempt in range(2):
+            if self._server is None:
+                self._server = self._connect()
+            try:
+                self._server.send_message(msg)
+                return
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                self._disconnect()
+                if attempt:
+                    raise
+            except Exception:
+                self._disconnect()
+                raise
+
+    async def send(self, msg: MIMEMultipart):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._send, msg)
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._disconnect)
+        self._executor.shutdown(wait=False)
+
+mailer = SMTPMailer(email_settings)
+
+# Email outbox: handlers queue messages in MongoDB, a background dispatcher delivers them
+EMAIL_OUTBOX_BATCH_SIZE = 50
+EMAIL_OUTBOX_MAX_ATTEMPTS = 6
+EMAIL_OUTBOX_RETRY_BASE_SECONDS = 30
+EMAIL_OUTBOX_POLL_SECONDS = 5
+# Renewed before each send, so it only has to outlast a single SMTP send
+EMAIL_OUTBOX_LEASE_SECONDS = 300
+
+# Bodies may carry credentials, so they are dropped once a message is sent or given up on
+EMAIL_BODY_REDACTED = {"body": None, "html_body": None}
+
+outbox_wakeup: Optional[asyncio.Event] = None
+outbox_metrics = {
+    "enqueued": 0,
+    "deduplicated": 0,
+    "sent": 0,
+    "retried": 0,
+    "failed": 0,
+    "last_latency_seconds": None
+}
+email_dispatcher_task: Optional[asyncio.Task] = None
+
+# Admin dashboard counters are cached briefly and invalidated on request changes
+DASHBOARD_CACHE_TTL_SECONDS = 30
+dashboard_cache: Dict[str, Any] = {"stats": None, "expires_at": 0.0}
+
 # ===== MODELS =====
 
 class User(BaseModel):
@@ -74,6 +426,11 @@ class UserCreate(BaseModel):
             raise ValueError('Username deve essere almeno 3 caratteri')
         return v
     
+    @validator('email')
+    def normalize_email(cls, v):
+        # Stored lowercased: the duplicate checks compare emails case-insensitively
+        return v.lower()
+    
     @validator('password')
     def validate_password(cls, v):
         if len(v) < 6:
@@ -139,10 +496,12 @@ class LeaveRequestCreate(BaseModel):
             if v < values.get('start_date'):
                 raise ValueError('Data di fine deve essere dopo la data di inizio')
             
-            # Check max 15 consecutive days
-            days_diff = (v - values.get('start_date')).days + 1
-            if days_diff > 15:
-                raise ValueError('Massimo 15 giorni consecutivi per le ferie')
+            # Check max 15 working days (weekends and public holidays are not counted)
+            working_days = working_days_between(values.get('start_date'), v)
+            if working_days == 0:
+                raise ValueError('Il periodo selezionato non contiene giorni lavorativi')
+            if working_days > 15:
+                raise ValueError('Massimo 15 giorni lavorativi per le ferie')
         return v
 
 class AdminResponse(BaseModel):
@@ -150,6 +509,26 @@ class AdminResponse(BaseModel):
     action: str  # "approve" or "reject"
     notes: Optional[str] = None
 
+class BulkAdminResponse(BaseModel):
+    request_ids: List[str]
+    action: str  # "approve" or "reject"
+    notes: Optional[str] = None
+    
+    @validator('request_ids')
+    def validate_request_ids(cls, v):
+        v = list(dict.fromkeys(v))
+        if not v:
+            raise ValueError('Seleziona almeno una richiesta')
+        if len(v) > BULK_RESPONSE_MAX_REQUESTS:
+            raise ValueError(f'Massimo {BULK_RESPONSE_MAX_REQUESTS} richieste alla volta')
+        return v
+    
+    @validator('action')
+    def validate_action(cls, v):
+        if v not in ['approve', 'reject']:
+            raise ValueError('Azione deve essere: approve o reject')
+        return v
+
 class DashboardStats(BaseModel):
     pending_ferie: int
     pending_permessi: int
@@ -159,129 +538,466 @@ class DashboardStats(BaseModel):
 class AdminSettings(BaseModel):
     email: EmailStr
 
+class YearlyStats(BaseModel):
+    year: int
+    ferie_days: int
+    permessi_count: int
+    malattie_days: int
+    total_requests: int
+
+class VacationRollover(BaseModel):
+    year: int
+    max_days: int = 20
+    
+    @validator('max_days')
+    def validate_max_days(cls, v):
+        if v < 0 or v > 50:
+            raise ValueError('I giorni massimi devono essere tra 0 e 50')
+        return v
+
+class UserCache:
+    """Bounded LRU cache of authenticated users, each entry expiring after a TTL"""
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, user_id: str) -> Optional[User]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        expires_at, user = entry
+        if expires_at <= monotonic():
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        return user
+
+    def set(self, user: User):
+        self._entries[user.id] = (monotonic() + self.ttl_seconds, user)
+        self._entries.move_to_end(user.id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: str):
+        self._entries.pop(user_id, None)
+
+# Resolved users for get_current_user; invalidated whenever a user document changes
+USER_CACHE_MAX_SIZE = 5000
+USER_CACHE_TTL_SECONDS = 60
+user_cache = UserCache(USER_CACHE_MAX_SIZE, USER_CACHE_TTL_SECONDS)
+
+class EventBroker:
+    """In-process fan-out of request events to the open event streams.
+    
+    Admins receive every event, employees only the events of their own
+    requests. A subscriber that falls behind by more than queue_size events
+    is disconnected and its client reconnects and reloads.
+    """
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self._subscribers: Dict[asyncio.Queue, Tuple[str, bool]] = {}
+
+    def subscribe(self, user: User) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers[queue] = (user.id, user.role == "admin")
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.pop(queue, None)
+
+    def publish(self, event: str, data: dict, user_id: Optional[str] = None, admin_only: bool = False):
+        for queue, (subscriber_id, is_admin) in list(self._subscribers.items()):
+            if not is_admin and (admin_only or subscriber_id != user_id):
+                continue
+            try:
+                queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                # Replace the backlog with the end-of-stream marker
+                self.unsubscribe(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+# Live request events for GET /api/events
+EVENT_QUEUE_SIZE = 100
+EVENT_KEEPALIVE_SECONDS = 15
+# Lifetime of the stream-only token passed to GET /api/events in the query string
+EVENT_TOKEN_TTL_SECONDS = 60
+event_broker = EventBroker(EVENT_QUEUE_SIZE)
+
 # ===== UTILITY FUNCTIONS =====
 
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+async def hash_password(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, pwd_context.hash, password)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, pwd_context.verify, plain_password, hashed_password)
 
-def create_access_token(data: dict):
+def create_access_token(data: dict, expires_delta: timedelta = timedelta(days=30)):
     to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(days=30)  # Long-lived token
+    expire = datetime.utcnow() + expires_delta  # Long-lived token by default
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def user_from_token(token: str, scope: Optional[str] = None) -> User:
+    """Resolve the user of a JWT; scoped tokens are only accepted where that scope is expected"""
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         user_id: str = payload.get("sub")
-        if user_id is None:
+        if user_id is None or payload.get("scope") != scope:
             raise HTTPException(status_code=401, detail="Token invalido")
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Token invalido")
     
+    cached_user = user_cache.get(user_id)
+    if cached_user is not None:
+        return cached_user
+    
     user = await db.users.find_one({"id": user_id})
     if user is None:
         raise HTTPException(status_code=401, detail="Utente non trovato")
-    return User(**user)
+    
+    resolved_user = User(**user)
+    user_cache.set(resolved_user)
+    return resolved_user
 
-async def send_email(to_email: str, subject: str, body: str, html_body: str = None):
-    """Send email using SMTP Gmail"""
-    try:
-        if not email_settings.admin_email or not email_settings.admin_password:
-            logging.warning("Email credentials not configured")
-            return False
-        
-        msg = MIMEMultipart('alternative')
-        msg['From'] = f"{email_settings.from_name} <{email_settings.admin_email}>"
-        msg['To'] = to_email
-        msg['Subject'] = subject
-        
-        # Add plain text
-        text_part = MIMEText(body, 'plain', 'utf-8')
-        msg.attach(text_part)
-        
-        # Add HTML if provided
-        if html_body:
-            html_part = MIMEText(html_body, 'html', 'utf-8')
-            msg.attach(html_part)
-        
-        # Send email
-        server = smtplib.SMTP(email_settings.smtp_server, email_settings.smtp_port)
-        server.starttls()
-        server.login(email_settings.admin_email, email_settings.admin_password)
-        server.send_message(msg)
-        server.quit()
-        
-        logging.info(f"Email sent successfully to {to_email}")
-        return True
-        
-    except Exception as e:
-        logging.error(f"Failed to send email: {e}")
-        return False
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return await user_from_token(credentials.credentials)
+
+async def get_event_stream_user(token: str = Query(...)):
+    """EventSource cannot send headers, so the event stream takes a short-lived
+    token from POST /api/events/token as a query parameter"""
+    return await user_from_token(token, scope="events")
+
+def build_email_message(to_email: str, subject: str, body: str, html_body: str = None) -> MIMEMultipart:
+    """Build a multipart email with a plain text and an optional HTML part"""
+    msg = MIMEMultipart('alternative')
+    msg['From'] = f"{email_settings.from_name} <{email_settings.admin_email}>"
+    msg['To'] = to_email
+    msg['Subject'] = subject
+    
+    # Add plain text
+    text_part = MIMEText(body, 'plain', 'utf-8')
+    msg.attach(text_part)
+    
+    # Add HTML if provided
+    if html_body:
+        html_part = MIMEText(html_body, 'html', 'utf-8')
+        msg.attach(html_part)
+    
+    return msg
 
-async def send_email(to_email: str, subject: str, body: str, html_body: str = None):
-    """Send email using SMTP Gmail"""
+async def enqueue_email(to_email: str, subject: str, body: str, html_body: str = None, dedup_key: str = None):
+    """Queue an email in the durable outbox; the dispatcher delivers it.
+    
+    Messages sharing a dedup_key are queued only once.
+    """
+    await enqueue_emails([{
+        "to_email": to_email, "subject": subject, "body": body, "html_body": html_body, "dedup_key": dedup_key
+    }])
+
+async def enqueue_emails(messages: List[dict]):
+    """Queue several emails with a single bulk_write.
+    
+    Each message has to_email, subject, body and optionally html_body and
+    dedup_key; messages whose dedup_key is already queued are skipped.
+    """
+    if not messages:
+        return
+    
+    now = datetime.utcnow()
+    operations = []
+    for message in messages:
+        email_doc = {
+            "id": str(uuid.uuid4()),
+            "to_email": message['to_email'],
+            "subject": message['subject'],
+            "body": message['body'],
+            "html_body": message.get('html_body'),
+            "status": "pending",
+            "attempts": 0,
+            "last_error": None,
+            "created_at": now,
+            "next_attempt_at": now
+        }
+        if message.get('dedup_key'):
+            email_doc["dedup_key"] = message['dedup_key']
+            operations.append(UpdateOne({"dedup_key": message['dedup_key']}, {"$setOnInsert": email_doc}, upsert=True))
+        else:
+            operations.append(InsertOne(email_doc))
+    
     try:
-        if not email_settings.admin_email or not email_settings.admin_password:
-            logging.warning("Email credentials not configured")
-            return False
-        
-        msg = MIMEMultipart('alternative')
-        msg['From'] = f"{email_settings.from_name} <{email_settings.admin_email}>"
-        msg['To'] = to_email
-        msg['Subject'] = subject
-        
-        # Add plain text
-        text_part = MIMEText(body, 'plain', 'utf-8')
-        msg.attach(text_part)
-        
-        # Add HTML if provided
-        if html_body:
-            html_part = MIMEText(html_body, 'html', 'utf-8')
-            msg.attach(html_part)
-        
-        # Send email
-        server = smtplib.SMTP(email_settings.smtp_server, email_settings.smtp_port)
-        server.starttls()
-        server.login(email_settings.admin_email, email_settings.admin_password)
-        server.send_message(msg)
-        server.quit()
+        result = await db.email_outbox.bulk_write(operations, ordered=False)
+        enqueued = result.inserted_count + result.upserted_count
+    except BulkWriteError as e:
+        # Concurrent upserts of the same dedup_key lose the race with a duplicate key error
+        if any(error['code'] != 11000 for error in e.details['writeErrors']):
+            raise
+        enqueued = e.details['nInserted'] + e.details['nUpserted']
+    
+    outbox_metrics["enqueued"] += enqueued
+    outbox_metrics["deduplicated"] += len(operations) - enqueued
+    if enqueued and outbox_wakeup is not None:
+        outbox_wakeup.set()
+
+async def claim_outbox_batch() -> List[dict]:
+    """Atomically claim the next batch of due emails for this dispatcher"""
+    now = datetime.utcnow()
+    due = {
+        "$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now}},
+            # Emails left in "sending" by a crashed dispatcher
+            {"status": "sending", "claimed_at": {"$lt": now - timedelta(seconds=EMAIL_OUTBOX_LEASE_SECONDS)}}
+        ]
+    }
+    candidates = await db.email_outbox.find(due, {"_id": 0, "id": 1}).sort("next_attempt_at", 1).limit(EMAIL_OUTBOX_BATCH_SIZE).to_list(None)
+    if not candidates:
+        return []
+    
+    claim_id = str(uuid.uuid4())
+    await db.email_outbox.update_many(
+        {"$and": [{"id": {"$in": [c['id'] for c in candidates]}}, due]},
+        {"$set": {"status": "sending", "claim_id": claim_id, "claimed_at": now}}
+    )
+    return await db.email_outbox.find({"claim_id": claim_id, "status": "sending"}).to_list(None)
+
+async def dispatch_outbox_batch() -> int:
+    """Deliver one batch of queued emails and record the outcome of each"""
+    batch = await claim_outbox_batch()
+    if not batch:
+        return 0
+    
+    claim_id = batch[0]['claim_id']
+    updates = []
+    for email_doc in batch:
+        # Renew the lease of the whole batch before each send: outcomes are only written at the
+        # end, and a batch of slow sends would otherwise outlast it and be claimed again
+        await db.email_outbox.update_many(
+            {"claim_id": claim_id, "status": "sending"}, {"$set": {"claimed_at": datetime.utcnow()}}
+        )
+        msg = build_email_message(email_doc['to_email'], email_doc['subject'], email_doc['body'], email_doc.get('html_body'))
+        try:
+            await mailer.send(msg)
+        except Exception as e:
+            attempts = email_doc['attempts'] + 1
+            if attempts >= EMAIL_OUTBOX_MAX_ATTEMPTS:
+                logging.error(f"Giving up on email {email_doc['id']} to {email_doc['to_email']}: {e}")
+                outbox_metrics["failed"] += 1
+                update = {"status": "failed", "attempts": attempts, "last_error": str(e), **EMAIL_BODY_REDACTED}
+            else:
+                delay = EMAIL_OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1)
+                logging.warning(f"Failed to send email {email_doc['id']}, retrying in {delay}s: {e}")
+                outbox_metrics["retried"] += 1
+                update = {
+                    "status": "pending",
+                    "attempts": attempts,
+                    "last_error": str(e),
+                    "next_attempt_at": datetime.utcnow() + timedelta(seconds=delay)
+                }
+        else:
+            sent_at = datetime.utcnow()
+            outbox_metrics["sent"] += 1
+            outbox_metrics["last_latency_seconds"] = (sent_at - email_doc['created_at']).total_seconds()
+            logging.info(f"Email sent successfully to {email_doc['to_email']}")
+            update = {"status": "sent", "attempts": email_doc['attempts'] + 1, "sent_at": sent_at, **EMAIL_BODY_REDACTED}
         
-        logging.info(f"Email sent successfully to {to_email}")
-        return True
+        updates.append(UpdateOne({"id": email_doc['id'], "claim_id": email_doc['claim_id']}, {"$set": update}))
+    
+    await db.email_outbox.bulk_write(updates, ordered=False)
+    return len(batch)
+
+async def run_email_dispatcher():
+    """Drain the email outbox until the application shuts down"""
+    while True:
+        try:
+            # SMTPMailer only logs in when a password is configured, so an
+            # unauthenticated relay works with ADMIN_EMAIL alone
+            if email_settings.admin_email:
+                # Keep draining while full batches come back
+                while await dispatch_outbox_batch() == EMAIL_OUTBOX_BATCH_SIZE:
+                    pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Email dispatcher error: {e}")
         
-    except Exception as e:
-        logging.error(f"Failed to send email: {e}")
-        return False
+        outbox_wakeup.clear()
+        try:
+            await asyncio.wait_for(outbox_wakeup.wait(), timeout=EMAIL_OUTBOX_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
 
-async def calculate_used_vacation_days(user_id: str, year: int) -> int:
-    """Calculate used vacation days for a user in a specific year"""
-    start_date = datetime(year, 1, 1)
-    end_date = datetime(year, 12, 31, 23, 59, 59)
+# $group accumulators for approved leave totals, shared by the live and the rebuild aggregations.
+# They sum the per-year shares precomputed on each request (see leave_days_by_year),
+# after LEAVE_YEAR_STAGES has kept the share of the requested year(s)
+LEAVE_STATS_TOTALS = {
+    key: {"$sum": f"$days_by_year.{key}"}
+    for key in ("ferie_days", "permessi_count", "malattie_days", "total_requests")
+}
+
+def leave_year_stages(year_filter) -> List[dict]:
+    """Pipeline stages turning each request into its share of the matching years"""
+    return [
+        {"$unwind": "$days_by_year"},
+        {"$match": {"days_by_year.year": year_filter}}
+    ]
+
+def leave_stats_from_totals(totals: dict) -> dict:
+    """Normalise aggregation totals (doubles, missing keys) to integer stats"""
+    return {key: int(totals.get(key) or 0) for key in LEAVE_STATS_TOTALS}
+
+async def compute_leave_stats(user_id: str, year: int, request_type: str = None) -> dict:
+    """Compute approved leave totals for a user in a year inside MongoDB.
     
-    requests = await db.requests.find({
+    Only the totals leave the database: ferie working days, permessi count
+    and malattia days.
+    """
+    match = {
         "user_id": user_id,
-        "type": "ferie",
         "status": "approved",
-        "created_at": {"$gte": start_date, "$lte": end_date}
-    }).to_list(None)
+        "days_by_year.year": year
+    }
+    if request_type:
+        match["type"] = request_type
     
-    total_days = 0
-    for req in requests:
-        if req.get('start_date') and req.get('end_date'):
-            start = datetime.fromisoformat(req['start_date']) if isinstance(req['start_date'], str) else req['start_date']
-            end = datetime.fromisoformat(req['end_date']) if isinstance(req['end_date'], str) else req['end_date']
-            total_days += (end - start).days + 1
+    pipeline = [
+        {"$match": match},
+        *leave_year_stages(year),
+        {"$group": {"_id": None, **LEAVE_STATS_TOTALS}}
+    ]
+    
+    result = await db.requests.aggregate(pipeline).to_list(1)
+    return leave_stats_from_totals(result[0] if result else {})
+
+def leave_days_by_year(request_doc: dict) -> List[dict]:
+    """Split a request into the amounts it adds to the stats of each calendar year it touches.
+    
+    Ferie count the working days falling in each year, malattia the calendar
+    days; a permesso belongs to the year of its date. Requests without dates
+    fall back to the year they were created in.
+    """
+    absence_start, absence_end = absence_range(request_doc)
+    if not absence_start:
+        created_at = request_doc.get('created_at') or datetime.utcnow()
+        return [{"year": created_at.year, "ferie_days": 0, "permessi_count": 0, "malattie_days": 0, "total_requests": 1}]
+    
+    start, end = absence_start.date(), absence_end.date()
+    shares = []
+    for year in range(start.year, end.year + 1):
+        first, last = max(start, date(year, 1, 1)), min(end, date(year, 12, 31))
+        share = {"year": year, "ferie_days": 0, "permessi_count": 0, "malattie_days": 0, "total_requests": 1}
+        if request_doc['type'] == 'ferie':
+            share["ferie_days"] = working_days_between(first, last)
+        elif request_doc['type'] == 'permesso':
+            share["permessi_count"] = 1
+        elif request_doc['type'] == 'malattia':
+            share["malattie_days"] = (last - first).days + 1
+        shares.append(share)
+    return shares
+
+# (request document, previous status, new status) of a handled request
+StatusTransition = Tuple[dict, str, str]
+
+def approval_sign(old_status: str, new_status: str) -> int:
+    """+1 for an approval, -1 for a reversal of an approval, 0 otherwise"""
+    was_approved = old_status == "approved"
+    is_approved = new_status == "approved"
+    if was_approved == is_approved:
+        return 0
+    return 1 if is_approved else -1
+
+async def update_yearly_stats_on_status_changes(transitions: List[StatusTransition]):
+    """Apply approvals and reversals to the materialized yearly_stats with one $inc bulk_write"""
+    increments: Dict[tuple, Dict[str, int]] = {}
+    for request_doc, old_status, new_status in transitions:
+        sign = approval_sign(old_status, new_status)
+        if not sign:
+            continue
+        for share in leave_days_by_year(request_doc):
+            totals = increments.setdefault(
+                (request_doc['user_id'], share['year']), {key: 0 for key in LEAVE_STATS_TOTALS}
+            )
+            for key in LEAVE_STATS_TOTALS:
+                totals[key] += sign * share[key]
+    if not increments:
+        return
     
-    return total_days
+    now = datetime.utcnow()
+    await db.yearly_stats.bulk_write([
+        UpdateOne(
+            {"user_id": user_id, "year": year},
+            {"$inc": totals, "$set": {"updated_at": now}},
+            upsert=True
+        )
+        for (user_id, year), totals in increments.items()
+    ], ordered=False)
+
+async def get_yearly_stats(user_id: str, year: int) -> YearlyStats:
+    """Read the materialized stats of a user for a year (zeros if none)"""
+    stats_doc = await db.yearly_stats.find_one({"user_id": user_id, "year": year}, {"_id": 0})
+    return YearlyStats(year=year, **leave_stats_from_totals(stats_doc or {}))
+
+async def rebuild_yearly_stats(write: bool = True) -> dict:
+    """Recompute yearly_stats from db.requests and report drift.
+    
+    With write=False the collection is only verified, not corrected.
+    """
+    pipeline = [
+        {"$match": {"status": "approved"}},
+        {"$unwind": "$days_by_year"},
+        {"$group": {"_id": {"user_id": "$user_id", "year": "$days_by_year.year"}, **LEAVE_STATS_TOTALS}}
+    ]
+    expected = {}
+    async for item in db.requests.aggregate(pipeline):
+        expected[(item['_id']['user_id'], item['_id']['year'])] = leave_stats_from_totals(item)
+    
+    zero_stats = leave_stats_from_totals({})
+    drift = []
+    seen = set()
+    async for stats_doc in db.yearly_stats.find({}, {"_id": 0}):
+        key = (stats_doc['user_id'], stats_doc['year'])
+        seen.add(key)
+        stored = leave_stats_from_totals(stats_doc)
+        if stored != expected.get(key, zero_stats):
+            drift.append({"user_id": key[0], "year": key[1], "stored": stored, "expected": expected.get(key, zero_stats)})
+    for key, stats in expected.items():
+        if key not in seen:
+            drift.append({"user_id": key[0], "year": key[1], "stored": None, "expected": stats})
+    
+    if write and drift:
+        now = datetime.utcnow()
+        updates = [
+            UpdateOne(
+                {"user_id": item['user_id'], "year": item['year']},
+                {"$set": {**item['expected'], "updated_at": now}},
+                upsert=True
+            )
+            for item in drift
+        ]
+        for i in range(0, len(updates), 1000):
+            await db.yearly_stats.bulk_write(updates[i:i + 1000], ordered=False)
+    
+    return {"checked": len(expected.keys() | seen), "drift": drift, "corrected": write}
+
+async def calculate_used_vacation_days(user_id: str, year: int) -> int:
+    """Calculate used vacation days for a user in a specific year"""
+    stats = await compute_leave_stats(user_id, year, request_type="ferie")
+    return stats["ferie_days"]
 
 async def get_or_create_vacation_allowance(user_id: str, year: int, default_max_days: int = 20):
-    """Get existing vacation allowance or create new one"""
+    """Get existing vacation allowance or create new one.
+    
+    Creation is an upsert on the unique {user_id, year} key, so concurrent
+    callers end up sharing a single allowance.
+    """
     allowance = await db.vacation_allowances.find_one({"user_id": user_id, "year": year})
     
     if not allowance:
@@ -303,54 +1019,820 @@ async def get_or_create_vacation_allowance(user_id: str, year: int, default_max_
             "used_days": used_days,
             "carried_over_days": carried_over_days,
             "remaining_days": default_max_days + carried_over_days - used_days,
+            "version": 0,
             "created_at": datetime.utcnow()
         }
         
-        await db.vacation_allowances.insert_one(allowance_data)
-        allowance = allowance_data
+        try:
+            allowance = await db.vacation_allowances.find_one_and_update(
+                {"user_id": user_id, "year": year},
+                {"$setOnInsert": allowance_data},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # A concurrent request created it first
+            allowance = await db.vacation_allowances.find_one({"user_id": user_id, "year": year})
     
     return allowance
 
-async def recalculate_vacation_allowance(user_id: str, year: int):
-    """Recalculate vacation allowance for a specific year"""
-    allowance = await db.vacation_allowances.find_one({"user_id": user_id, "year": year})
-    if not allowance:
-        return await get_or_create_vacation_allowance(user_id, year)
-    
-    # Recalculate used days
-    used_days = await calculate_used_vacation_days(user_id, year)
+async def rollover_vacation_allowances(
+    year: int,
+    default_max_days: int = 20,
+    batch_size: int = 1000,
+    progress: Optional[Callable[[int, int], None]] = None
+) -> dict:
+    """Create the allowance of every active employee for a year in bulk.
+    
+    Employees are processed in batches: per batch, existing allowances, the
+    previous year's balances and the used days are read concurrently, then
+    missing allowances are written with a single unordered bulk_write of
+    upserts, so the job can be re-run safely.
+    """
+    employee_ids = [
+        emp['id'] async for emp in db.users.find({"role": "employee", "is_active": True}, {"_id": 0, "id": 1})
+    ]
+    created = 0
+    
+    for offset in range(0, len(employee_ids), batch_size):
+        batch = employee_ids[offset:offset + batch_size]
+        
+        existing_docs, previous_docs, used_docs = await asyncio.gather(
+            db.vacation_allowances.find(
+                {"user_id": {"$in": batch}, "year": year}, {"_id": 0, "user_id": 1}
+            ).to_list(None),
+            db.vacation_allowances.find(
+                {"user_id": {"$in": batch}, "year": year - 1}, {"_id": 0, "user_id": 1, "remaining_days": 1}
+            ).to_list(None),
+            db.requests.aggregate([
+                {"$match": {
+                    "user_id": {"$in": batch},
+                    "type": "ferie",
+                    "status": "approved",
+                    "days_by_year.year": year
+                }},
+                *leave_year_stages(year),
+                {"$group": {"_id": "$user_id", "ferie_days": LEAVE_STATS_TOTALS["ferie_days"]}}
+            ]).to_list(None)
+        )
+        existing = {doc['user_id'] for doc in existing_docs}
+        carried_over = {doc['user_id']: max(0, doc['remaining_days']) for doc in previous_docs}
+        used = {doc['_id']: int(doc['ferie_days']) for doc in used_docs}
+        
+        now = datetime.utcnow()
+        operations = []
+        for user_id in batch:
+            if user_id in existing:
+                continue
+            carried_over_days = carried_over.get(user_id, 0)
+            used_days = used.get(user_id, 0)
+            operations.append(UpdateOne(
+                {"user_id": user_id, "year": year},
+                {"$setOnInsert": {
+                    "id": str(uuid.uuid4()),
+                    "user_id": user_id,
+                    "year": year,
+                    "max_days": default_max_days,
+                    "used_days": used_days,
+                    "carried_over_days": carried_over_days,
+                    "remaining_days": default_max_days + carried_over_days - used_days,
+                    "version": 0,
+                    "created_at": now
+                }},
+                upsert=True
+            ))
+        
+        if operations:
+            result = await db.vacation_allowances.bulk_write(operations, ordered=False)
+            created += result.upserted_count
+        
+        if progress:
+            progress(min(offset + batch_size, len(employee_ids)), len(employee_ids))
+    
+    return {
+        "year": year,
+        "employees": len(employee_ids),
+        "created": created,
+        "skipped": len(employee_ids) - created
+    }
+
+# One recomputation per user at a time in this process, so they don't keep invalidating each other
+recompute_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+async def recompute_vacation_allowances(
+    user_id: str, from_year: int, max_days: Optional[int] = None, max_attempts: Optional[int] = 5
+):
+    """Recompute used days and the carry-over chain from from_year onward.
+    
+    All allowances and the used days per year are fetched once, the chain is
+    computed in memory and the changed years are written back with a single
+    bulk_write guarded by each allowance's version; on a concurrent change
+    the computation is simply redone (max_attempts=None: until it sticks).
+    max_days optionally replaces the allowance of from_year.
+    
+    The allowances are read before the requests: a ledger $inc landing after
+    the allowance read bumps the version and voids this write, so the result
+    never counts an approval twice or misses one.
+    """
+    lock = recompute_locks.get(user_id)
+    if lock is None:
+        lock = recompute_locks[user_id] = asyncio.Lock()
+    async with lock:
+        await _recompute_vacation_allowances(user_id, from_year, max_days, max_attempts)
+
+async def _recompute_vacation_allowances(user_id: str, from_year: int, max_days: Optional[int], max_attempts: Optional[int]):
+    attempt = 0
+    while max_attempts is None or attempt < max_attempts:
+        attempt += 1
+        allowances = await db.vacation_allowances.find(
+            {"user_id": user_id, "year": {"$gte": from_year - 1}}
+        ).sort("year", 1).to_list(None)
+        used_result = await db.requests.aggregate([
+            {"$match": {
+                "user_id": user_id,
+                "type": "ferie",
+                "status": "approved",
+                "days_by_year.year": {"$gte": from_year}
+            }},
+            *leave_year_stages({"$gte": from_year}),
+            {"$group": {"_id": "$days_by_year.year", "ferie_days": LEAVE_STATS_TOTALS["ferie_days"]}}
+        ]).to_list(None)
+        used_by_year = {item['_id']: int(item['ferie_days']) for item in used_result}
+        remaining_by_year = {a['year']: a['remaining_days'] for a in allowances if a['year'] < from_year}
+        
+        now = datetime.utcnow()
+        operations = []
+        for allowance in allowances:
+            year = allowance['year']
+            if year < from_year:
+                continue
+            
+            new_max_days = max_days if (year == from_year and max_days is not None) else allowance['max_days']
+            used_days = used_by_year.get(year, 0)
+            carried_over_days = allowance['carried_over_days']
+            if year - 1 in remaining_by_year:
+                carried_over_days = max(0, remaining_by_year[year - 1])
+            remaining_days = new_max_days + carried_over_days - used_days
+            remaining_by_year[year] = remaining_days
+            
+            values = {
+                "max_days": new_max_days,
+                "used_days": used_days,
+                "carried_over_days": carried_over_days,
+                "remaining_days": remaining_days
+            }
+            if all(allowance.get(key) == value for key, value in values.items()):
+                continue
+            operations.append(UpdateOne(
+                {"user_id": user_id, "year": year, "version": allowance.get('version')},
+                {"$set": {**values, "updated_at": now}, "$inc": {"version": 1}}
+            ))
+        
+        if not operations:
+            return
+        result = await db.vacation_allowances.bulk_write(operations, ordered=False)
+        if result.matched_count == len(operations):
+            return
+    
+    logging.warning(f"Vacation allowances of {user_id} kept changing during recomputation from {from_year}")
+
+def as_date(value) -> Optional[date]:
+    """Read a stored date that may be an ISO string, a datetime or a date"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return date.fromisoformat(value[:10])
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+def absence_range(request_doc: dict):
+    """First and last day a request keeps the employee away, as midnight datetimes"""
+    start = end = None
+    if request_doc.get('type') == 'ferie':
+        start, end = as_date(request_doc.get('start_date')), as_date(request_doc.get('end_date'))
+    elif request_doc.get('type') == 'permesso':
+        start = end = as_date(request_doc.get('permit_date'))
+    elif request_doc.get('type') == 'malattia':
+        start = as_date(request_doc.get('sick_start_date'))
+        if start:
+            end = start + timedelta(days=max(1, request_doc.get('sick_days') or 1) - 1)
+    
+    if not start or not end:
+        return None, None
+    return datetime.combine(start, time.min), datetime.combine(end, time.min)
+
+def derived_request_fields(request_doc: dict) -> dict:
+    """Fields computed from a request's dates and stored with it for indexed queries"""
+    absence_start, absence_end = absence_range(request_doc)
+    working_days = None
+    if request_doc.get('type') == 'ferie' and absence_start:
+        working_days = working_days_between(absence_start.date(), absence_end.date())
+    return {
+        "absence_start": absence_start,
+        "absence_end": absence_end,
+        "working_days": working_days,
+        "days_by_year": leave_days_by_year(request_doc)
+    }
+
+async def backfill_request_fields() -> dict:
+    """Store the derived fields on requests created before they existed.
+    
+    Returns the number of updated requests, whether approved ones were
+    among them (their stats have to be rebuilt) and the users with approved
+    ferie, whose vacation totals have to be recomputed.
+    """
+    updates = []
+    updated = 0
+    approved_found = False
+    affected_users = set()
+    async for request_doc in db.requests.find({"days_by_year": {"$exists": False}}, {"_id": 0}):
+        updates.append(UpdateOne({"id": request_doc['id']}, {"$set": derived_request_fields(request_doc)}))
+        if request_doc.get('status') == 'approved':
+            approved_found = True
+            if request_doc.get('type') == 'ferie':
+                affected_users.add(request_doc['user_id'])
+        if len(updates) == 1000:
+            updated += (await db.requests.bulk_write(updates, ordered=False)).modified_count
+            updates = []
+    if updates:
+        updated += (await db.requests.bulk_write(updates, ordered=False)).modified_count
+    return {"updated": updated, "approved_found": approved_found, "affected_users": affected_users}
+
+def absence_days(request_doc: dict) -> List[datetime]:
+    """Every day of a full-day absence (ferie or malattia), as midnight datetimes"""
+    if request_doc.get('type') not in ("ferie", "malattia"):
+        return []
+    absence_start, absence_end = absence_range(request_doc)
+    if not absence_start:
+        return []
+    return [absence_start + timedelta(days=i) for i in range((absence_end - absence_start).days + 1)]
+
+async def update_absence_headcount_on_status_changes(transitions: List[StatusTransition]):
+    """Keep the per-day count of approved absences in step with approvals and reversals"""
+    increments: Dict[datetime, int] = {}
+    for request_doc, old_status, new_status in transitions:
+        sign = approval_sign(old_status, new_status)
+        if not sign:
+            continue
+        for day in absence_days(request_doc):
+            increments[day] = increments.get(day, 0) + sign
+    
+    operations = [
+        UpdateOne({"day": day}, {"$inc": {"count": count}}, upsert=True)
+        for day, count in increments.items() if count
+    ]
+    if operations:
+        await db.absence_headcount.bulk_write(operations, ordered=False)
+
+async def rebuild_absence_headcount() -> int:
+    """Recompute absence_headcount from the approved requests"""
+    counts: Dict[datetime, int] = {}
+    async for request_doc in db.requests.find(
+        {"status": "approved", "type": {"$in": ["ferie", "malattia"]}},
+        {"_id": 0, "type": 1, "start_date": 1, "end_date": 1, "sick_start_date": 1, "sick_days": 1}
+    ):
+        for day in absence_days(request_doc):
+            counts[day] = counts.get(day, 0) + 1
+    
+    await db.absence_headcount.delete_many({})
+    if counts:
+        await db.absence_headcount.insert_many([{"day": day, "count": count} for day, count in counts.items()])
+    return len(counts)
+
+async def find_request_conflicts(user_id: str, request_dict: dict, exclude_id: Optional[str] = None) -> dict:
+    """Check a new or edited request against the employee's requests and the team coverage.
+    
+    Returns the overlapping requests of the same employee and, for vacations,
+    the days on which MAX_CONCURRENT_ABSENCES colleagues are already away.
+    """
+    conflicts = {"overlapping": [], "coverage_days": []}
+    absence_start, absence_end = request_dict.get('absence_start'), request_dict.get('absence_end')
+    if not absence_start:
+        return conflicts
+    
+    # Sick leave is certified and always accepted; a permesso only clashes with full-day absences
+    if request_dict['type'] != "malattia":
+        query = {
+            "user_id": user_id,
+            "absence_end": {"$gte": absence_start},
+            "absence_start": {"$lte": absence_end},
+            "status": {"$in": ["pending", "approved"]}
+        }
+        if request_dict['type'] == "permesso":
+            query["type"] = {"$in": ["ferie", "malattia"]}
+        if exclude_id:
+            query["id"] = {"$ne": exclude_id}
+        conflicts["overlapping"] = await db.requests.find(
+            query, {"_id": 0, "id": 1, "type": 1, "status": 1, "absence_start": 1, "absence_end": 1}
+        ).to_list(None)
+    
+    if request_dict['type'] == "ferie" and MAX_CONCURRENT_ABSENCES > 0:
+        full_days = db.absence_headcount.find(
+            {"day": {"$gte": absence_start, "$lte": absence_end}, "count": {"$gte": MAX_CONCURRENT_ABSENCES}},
+            {"_id": 0, "day": 1}
+        ).sort("day", 1)
+        conflicts["coverage_days"] = [item['day'].date().isoformat() async for item in full_days]
+    
+    return conflicts
+
+def raise_on_overlap(conflicts: dict):
+    """Reject a request that overlaps another pending or approved request of the same employee"""
+    if conflicts["overlapping"]:
+        first = conflicts["overlapping"][0]
+        raise HTTPException(
+            status_code=409,
+            detail=(
+                f"Esiste già una richiesta di {first['type']} nello stesso periodo "
+                f"({first['absence_start'].strftime('%d/%m/%Y')} - {first['absence_end'].strftime('%d/%m/%Y')})"
+            )
+        )
+
+async def attach_user_info(requests: List[dict]) -> List[dict]:
+    """Add username and email to each request with a single users query"""
+    user_ids = list({req['user_id'] for req in requests})
+    if not user_ids:
+        return requests
+    
+    users = await db.users.find(
+        {"id": {"$in": user_ids}},
+        {"_id": 0, "id": 1, "username": 1, "email": 1}
+    ).to_list(None)
+    users_by_id = {user['id']: user for user in users}
+    
+    for req in requests:
+        user = users_by_id.get(req['user_id'])
+        if user:
+            req['username'] = user['username']
+            req['user_email'] = user['email']
+    
+    return requests
+
+def encode_requests_cursor(request_doc: dict) -> str:
+    """Encode the (created_at, id) position of a request as an opaque cursor"""
+    payload = json.dumps({
+        "created_at": request_doc['created_at'].isoformat(),
+        "id": request_doc['id']
+    })
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+def decode_requests_cursor(cursor: str):
+    """Decode a cursor produced by encode_requests_cursor"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return datetime.fromisoformat(payload['created_at']), str(payload['id'])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursore non valido")
+
+def build_requests_filter(
+    user_id: Optional[str] = None,
+    request_status: Optional[str] = None,
+    request_type: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None
+) -> dict:
+    """Build the MongoDB filter for request listings and exports"""
+    query = {}
+    if user_id:
+        query["user_id"] = user_id
+    if request_status:
+        query["status"] = request_status
+    if request_type:
+        query["type"] = request_type
+    if date_from or date_to:
+        query["created_at"] = {}
+        if date_from:
+            query["created_at"]["$gte"] = datetime.combine(date_from, time.min)
+        if date_to:
+            query["created_at"]["$lte"] = datetime.combine(date_to, time.max)
+    return query
+
+def build_requests_projection(fields: Optional[str]) -> dict:
+    """Build a MongoDB projection from a comma separated list of request fields.
+    
+    Without fields, every stored field except the internal ones is returned.
+    """
+    if not fields:
+        return {"_id": 0, **{field: 0 for field in INTERNAL_REQUEST_FIELDS}}
+    
+    requested = {f.strip() for f in fields.split(',') if f.strip()}
+    unknown = requested - set(LeaveRequest.__fields__) - OPTIONAL_REQUEST_FIELDS
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Campi non validi: {', '.join(sorted(unknown))}")
+    
+    # Fields needed for the cursor and the admin user join are always returned
+    projection = {"_id": 0, "id": 1, "user_id": 1, "created_at": 1}
+    for field in requested:
+        projection[field] = 1
+    return projection
+
+# Leading characters that make Excel and LibreOffice evaluate a cell as a formula
+CSV_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+def csv_safe_row(doc: dict) -> dict:
+    """Quote text values that a spreadsheet would run as a formula (CSV injection)"""
+    return {
+        key: "'" + value if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES) else value
+        for key, value in doc.items()
+    }
+
+async def stream_csv(cursor, columns: List[str], enrich: Optional[Callable] = None, batch_size: int = EXPORT_BATCH_SIZE):
+    """Yield a CSV export of a Motor cursor one batch at a time.
+    
+    Only one batch of documents is held in memory; enrich, if given, is
+    awaited on each batch before it is written (e.g. to join user info).
+    Values come from employees, so cells are escaped with csv_safe_row.
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction="ignore")
+    
+    # BOM so that Excel opens the UTF-8 file with the right encoding
+    buffer.write("\ufeff")
+    writer.writeheader()
+    
+    batch = []
+    async for doc in cursor.batch_size(batch_size):
+        batch.append(doc)
+        if len(batch) < batch_size:
+            continue
+        if enrich:
+            await enrich(batch)
+        writer.writerows(map(csv_safe_row, batch))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        batch = []
+    
+    if enrich and batch:
+        await enrich(batch)
+    writer.writerows(map(csv_safe_row, batch))
+    yield buffer.getvalue()
+
+def csv_download(rows, filename: str) -> StreamingResponse:
+    return StreamingResponse(
+        rows,
+        media_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+async def attach_employee_info(allowances: List[dict]) -> List[dict]:
+    """Add username and email to vacation allowances with a single users query"""
+    user_ids = list({a['user_id'] for a in allowances})
+    users = await db.users.find(
+        {"id": {"$in": user_ids}},
+        {"_id": 0, "id": 1, "username": 1, "email": 1}
+    ).to_list(None)
+    users_by_id = {user['id']: user for user in users}
+    
+    for allowance in allowances:
+        user = users_by_id.get(allowance['user_id'], {})
+        allowance['username'] = user.get('username')
+        allowance['email'] = user.get('email')
+    
+    return allowances
+
+# Dashboard counter fed by each pending request type
+PENDING_COUNTERS = {"ferie": "pending_ferie", "permesso": "pending_permessi", "malattia": "pending_malattie"}
+
+def publish_request_event(event: str, request_doc: dict):
+    """Push a request change to its owner's and the admins' event streams"""
+    data = {
+        "id": request_doc['id'],
+        "user_id": request_doc['user_id'],
+        "type": request_doc['type'],
+        "status": request_doc.get('status', 'pending'),
+        "start": request_doc['absence_start'].date().isoformat() if request_doc.get('absence_start') else None,
+        "end": request_doc['absence_end'].date().isoformat() if request_doc.get('absence_end') else None
+    }
+    event_broker.publish(event, data, user_id=request_doc['user_id'])
+
+def publish_dashboard_delta(changes: Iterable[Tuple[str, int]]):
+    """Push the change of the admin dashboard counters for (request type, +1/-1) pending changes"""
+    delta: Dict[str, int] = {}
+    for request_type, amount in changes:
+        for key in (PENDING_COUNTERS.get(request_type), "total_pending"):
+            if key:
+                delta[key] = delta.get(key, 0) + amount
+    delta = {key: value for key, value in delta.items() if value}
+    if delta:
+        event_broker.publish("dashboard", delta, admin_only=True)
+
+def invalidate_dashboard_cache():
+    """Drop the cached dashboard counters after pending requests change"""
+    dashboard_cache["stats"] = None
+
+async def sync_carry_over(user_id: str, year: int) -> bool:
+    """Make year + 1 carry over the current remaining balance of year.
+    
+    The write is guarded by the target allowance's version (optimistic
+    concurrency) and re-checked against the source afterwards, so racing
+    updates converge on the latest balance. Returns whether anything changed.
+    """
+    changed = False
+    while True:
+        source = await db.vacation_allowances.find_one({"user_id": user_id, "year": year})
+        target = await db.vacation_allowances.find_one({"user_id": user_id, "year": year + 1})
+        if not source or not target:
+            return changed
+        
+        carried_over_days = max(0, source['remaining_days'])
+        if target['carried_over_days'] == carried_over_days:
+            return changed
+        
+        updated = await db.vacation_allowances.find_one_and_update(
+            {"user_id": user_id, "year": year + 1, "version": target.get('version')},
+            {
+                "$set": {
+                    "carried_over_days": carried_over_days,
+                    "remaining_days": target['max_days'] + carried_over_days - target['used_days'],
+                    "updated_at": datetime.utcnow()
+                },
+                "$inc": {"version": 1}
+            }
+        )
+        if updated:
+            changed = True
+
+async def propagate_carry_over(user_id: str, year: int):
+    """Push year's remaining balance into the carry-over of the following years.
+    
+    Stops at the first year whose carry-over does not change.
+    """
+    while await sync_carry_over(user_id, year):
+        year += 1
+
+def vacation_years(request_docs: List[dict]) -> set:
+    """(user_id, year) pairs whose allowance is affected by these ferie requests"""
+    return {
+        (request_doc['user_id'], share['year'])
+        for request_doc in request_docs if request_doc['type'] == "ferie"
+        for share in leave_days_by_year(request_doc) if share['ferie_days']
+    }
+
+async def ensure_vacation_allowances(request_docs: List[dict]) -> Dict[tuple, int]:
+    """Create the missing allowances of the years these ferie requests fall in.
+    
+    Called before the status changes, so a new allowance's initial used
+    days can never already include the transition applied by the ledger.
+    Returns the version of each (user_id, year) allowance as read here,
+    which the ledger requires to be unchanged when it applies its $inc.
+    """
+    pairs = vacation_years(request_docs)
+    if not pairs:
+        return {}
+    
+    existing = await db.vacation_allowances.find(
+        {"user_id": {"$in": list({user_id for user_id, _ in pairs})}, "year": {"$in": list({year for _, year in pairs})}},
+        {"_id": 0, "user_id": 1, "year": 1, "version": 1}
+    ).to_list(None)
+    versions = {(a['user_id'], a['year']): a.get('version') for a in existing}
+    created = await asyncio.gather(*[
+        get_or_create_vacation_allowance(user_id, year) for user_id, year in pairs - set(versions)
+    ])
+    versions.update({(a['user_id'], a['year']): a.get('version') for a in created})
+    return {pair: version for pair, version in versions.items() if pair in pairs}
+
+async def apply_vacation_ledger_entries(transitions: List[StatusTransition], allowance_versions: Dict[tuple, int]):
+    """Record approvals (debits) and reversals (credits) of ferie requests.
+    
+    One entry per request and year the vacation falls in is appended to
+    vacation_ledger; the net change of each allowance is applied with a
+    single $inc bulk_write, then each user's carry-over is propagated to
+    the following years.
+    
+    Each $inc only applies if the allowance still has the version read by
+    ensure_vacation_allowances before the status swap. Otherwise something
+    (a recomputation, another approval) wrote in between and may or may not
+    have counted this transition, so the user's allowances are recomputed
+    from the requests instead, which already carry the new status.
+    """
+    entries = []
+    deltas: Dict[tuple, int] = {}
+    now = datetime.utcnow()
+    for request_doc, old_status, new_status in transitions:
+        sign = approval_sign(old_status, new_status)
+        if request_doc['type'] != "ferie" or not sign:
+            continue
+        for share in leave_days_by_year(request_doc):
+            if not share['ferie_days']:
+                continue
+            entries.append({
+                "id": str(uuid.uuid4()),
+                "user_id": request_doc['user_id'],
+                "year": share['year'],
+                "request_id": request_doc['id'],
+                "kind": "debit" if sign > 0 else "credit",
+                "days": share['ferie_days'],
+                "created_at": now
+            })
+            key = (request_doc['user_id'], share['year'])
+            deltas[key] = deltas.get(key, 0) + sign * share['ferie_days']
+    if not entries:
+        return
+    
+    await db.vacation_ledger.insert_many(entries)
+    
+    # ledger_batch_id tells which allowances this call actually updated
+    ledger_batch_id = str(uuid.uuid4())
+    result = await db.vacation_allowances.bulk_write([
+        UpdateOne(
+            {"user_id": user_id, "year": year, "version": allowance_versions.get((user_id, year))},
+            {
+                "$inc": {"used_days": delta, "remaining_days": -delta, "version": 1},
+                "$set": {"updated_at": now, "ledger_batch_id": ledger_batch_id}
+            }
+        )
+        for (user_id, year), delta in deltas.items()
+    ], ordered=False)
+    if result.matched_count < len(deltas):
+        applied = await db.vacation_allowances.find(
+            {"user_id": {"$in": list({user_id for user_id, _ in deltas})}, "ledger_batch_id": ledger_batch_id},
+            {"_id": 0, "user_id": 1, "year": 1}
+        ).to_list(None)
+        stale_years: Dict[str, List[int]] = {}
+        for user_id, year in set(deltas) - {(a['user_id'], a['year']) for a in applied}:
+            stale_years.setdefault(user_id, []).append(year)
+        
+        async def recount_user(user_id: str, years: List[int]):
+            # A missing allowance is created from the requests, which already include these changes
+            for year in years:
+                await get_or_create_vacation_allowance(user_id, year)
+            await recompute_vacation_allowances(user_id, min(years), max_attempts=None)
+        
+        await asyncio.gather(*[recount_user(user_id, years) for user_id, years in stale_years.items()])
+    
+    years_by_user: Dict[str, List[int]] = {}
+    for user_id, year in deltas:
+        years_by_user.setdefault(user_id, []).append(year)
+    
+    async def propagate_user(user_id: str, years: List[int]):
+        for year in sorted(years):
+            await propagate_carry_over(user_id, year)
+    
+    await asyncio.gather(*[propagate_user(user_id, years) for user_id, years in years_by_user.items()])
+
+def credentials_email(username: str, password: str):
+    """Subject, text and HTML body of the email sent to a new employee"""
+    subject = "Credenziali di accesso - Sistema Gestione Ferie"
+    body = f"""
+    Ciao {username},
+    
+    È stato creato un account per te nel sistema di gestione ferie e permessi.
+    
+    Le tue credenziali di accesso sono:
+    Username: {username}
+    Password: {password}
+    
+    Puoi accedere al sistema utilizzando queste credenziali.
+    
+    Cordiali saluti,
+    Amministrazione
+    """
+    
+    html_body = f"""
+    <h2>Benvenuto nel Sistema Gestione Ferie</h2>
+    <p>Ciao <strong>{username}</strong>,</p>
+    <p>È stato creato un account per te nel sistema di gestione ferie e permessi.</p>
+    <div style="background: #f5f5f5; padding: 15px; margin: 15px 0; border-radius: 5px;">
+        <h3>Le tue credenziali:</h3>
+        <p><strong>Username:</strong> {username}</p>
+        <p><strong>Password:</strong> {password}</p>
+    </div>
+    <p>Puoi accedere al sistema utilizzando queste credenziali.</p>
+    <p>Cordiali saluti,<br>Amministrazione</p>
+    """
+    return subject, body, html_body
+
+def validation_error_message(error: ValidationError) -> str:
+    """Short Italian message for a pydantic validation error"""
+    messages = []
+    for item in error.errors():
+        message = item['msg'].replace('Value error, ', '')
+        messages.append(f"{item['loc'][0]}: {message}" if item['loc'] else message)
+    return "; ".join(messages)
+
+def parse_employee_rows(rows: Iterable[Tuple[int, dict]]) -> Tuple[List[Tuple[int, UserCreate]], List[dict]]:
+    """Validate employee CSV rows, as (line, row) pairs, with the UserCreate rules.
     
-    # Calculate remaining days
-    remaining_days = allowance['max_days'] + allowance['carried_over_days'] - used_days
+    Returns the (line, UserCreate) candidates, with lowercased emails and
+    no duplicates inside the file, and the per-row errors.
+    """
+    errors = []
+    candidates = []
+    seen_usernames, seen_emails = set(), set()
+    for line, row in rows:
+        # DictReader puts the fields beyond the header under the None key
+        extra_fields = [value for value in row.pop(None, None) or [] if value.strip()]
+        row = {key.strip().lower(): (value or "").strip() for key, value in row.items() if key is not None}
+        if not any(row.values()) and not extra_fields:
+            continue
+        if extra_fields:
+            errors.append({"line": line, "username": row.get('username'), "error": "Più colonne dell'intestazione"})
+            continue
+        # Employees without a password in the file get a generated one
+        password = row.get('password') or secrets.token_urlsafe(9)
+        try:
+            employee_data = UserCreate(username=row.get('username', ''), email=row.get('email', ''), password=password)
+        except ValidationError as e:
+            errors.append({"line": line, "username": row.get('username'), "error": validation_error_message(e)})
+            continue
+        
+        if employee_data.username in seen_usernames or employee_data.email in seen_emails:
+            errors.append({"line": line, "username": employee_data.username, "error": "Username o email duplicati nel file"})
+            continue
+        seen_usernames.add(employee_data.username)
+        seen_emails.add(employee_data.email)
+        candidates.append((line, employee_data))
+    return candidates, errors
+
+async def import_employees(rows: Iterable[Tuple[int, dict]]) -> dict:
+    """Create employees in bulk from CSV rows (username, email, optional password).
+    
+    Rows are validated by parse_employee_rows and checked against the
+    database with one $in query per field (emails case-insensitively).
+    Passwords are hashed in parallel on the bcrypt pool, the employees are
+    written with one unordered insert_many and the credential emails are
+    queued in the outbox. Rows that fail are reported with their CSV line
+    number.
+    """
+    candidates, errors = parse_employee_rows(rows)
+    
+    # Existing usernames and emails
+    if candidates:
+        taken_usernames = set(await db.users.distinct(
+            "username", {"username": {"$in": [data.username for _, data in candidates]}}
+        ))
+        existing_emails = await db.users.find(
+            {"email": {"$in": [data.email for _, data in candidates]}}, {"_id": 0, "email": 1},
+            collation=EMAIL_COLLATION
+        ).to_list(None)
+        taken_emails = {user['email'].lower() for user in existing_emails}
+        remaining = []
+        for line, data in candidates:
+            if data.username in taken_usernames or data.email in taken_emails:
+                errors.append({"line": line, "username": data.username, "error": "Username o email già esistente"})
+            else:
+                remaining.append((line, data))
+        candidates = remaining
+    
+    if not candidates:
+        return {"created": 0, "employee_ids": [], "errors": sorted(errors, key=lambda item: item['line'])}
+    
+    password_hashes = await asyncio.gather(*[hash_password(data.password) for _, data in candidates])
+    employees = [
+        User(username=data.username, email=data.email, password_hash=password_hash, role="employee")
+        for (_, data), password_hash in zip(candidates, password_hashes)
+    ]
     
-    # Update allowance
-    await db.vacation_allowances.update_one(
-        {"user_id": user_id, "year": year},
-        {
-            "$set": {
-                "used_days": used_days,
-                "remaining_days": remaining_days,
-                "updated_at": datetime.utcnow()
-            }
-        }
-    )
+    failed = set()
+    try:
+        await db.users.insert_many([employee.dict() for employee in employees], ordered=False)
+    except BulkWriteError as e:
+        # Usernames taken concurrently hit the unique index; everything else is a real failure
+        for error in e.details['writeErrors']:
+            if error['code'] != 11000:
+                raise
+            failed.add(error['index'])
+            line, data = candidates[error['index']]
+            errors.append({"line": line, "username": data.username, "error": "Username o email già esistente"})
+    
+    messages = []
+    created = []
+    for index, ((_, data), employee) in enumerate(zip(candidates, employees)):
+        if index in failed:
+            continue
+        created.append(employee.id)
+        subject, body, html_body = credentials_email(data.username, data.password)
+        messages.append({
+            "to_email": data.email, "subject": subject, "body": body, "html_body": html_body,
+            "dedup_key": f"credentials:{employee.id}"
+        })
+    await enqueue_emails(messages)
+    
+    return {"created": len(created), "employee_ids": created, "errors": sorted(errors, key=lambda item: item['line'])}
+
+def read_employee_csv(content: bytes) -> List[Tuple[int, dict]]:
+    """Parse an employee CSV (comma or semicolon separated, optional BOM).
     
-    # Update next year's carried over days if exists
-    next_year_allowance = await db.vacation_allowances.find_one({"user_id": user_id, "year": year + 1})
-    if next_year_allowance:
-        can_carry_over = max(0, remaining_days)
-        await db.vacation_allowances.update_one(
-            {"user_id": user_id, "year": year + 1},
-            {
-                "$set": {
-                    "carried_over_days": can_carry_over,
-                    "remaining_days": next_year_allowance['max_days'] + can_carry_over - next_year_allowance['used_days'],
-                    "updated_at": datetime.utcnow()
-                }
-            }
-        )
+    Returns (line, row) pairs, line being the line of the file where the
+    row ends, so blank lines and quoted line breaks are counted. Raises
+    ValueError if the file is not UTF-8 or lacks the required columns.
+    """
+    try:
+        text = content.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise ValueError("Il file deve essere in formato CSV UTF-8")
     
-    return await db.vacation_allowances.find_one({"user_id": user_id, "year": year})
+    try:
+        dialect = csv.Sniffer().sniff(text.split("\n", 1)[0], delimiters=",;")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.DictReader(io.StringIO(text), dialect=dialect)
+    
+    headers = {(name or "").strip().lower() for name in reader.fieldnames or []}
+    if not {"username", "email"} <= headers:
+        raise ValueError("Il file deve avere le colonne username ed email (password opzionale)")
+    return [(reader.line_num, row) for row in reader]
 
 # ===== ROUTES =====
 
@@ -369,7 +1851,7 @@ async def create_admin_user():
             "id": str(uuid.uuid4()),
             "username": "admin",
             "email": "admin@company.com",
-            "password_hash": hash_password(admin_password),
+            "password_hash": await hash_password(admin_password),
             "role": "admin",
             "created_at": datetime.utcnow(),
             "is_active": True
@@ -377,11 +1859,90 @@ async def create_admin_user():
         await db.users.insert_one(admin_data)
         logging.info("Admin user created - Username: admin, Password: admin123")
 
+# Ensure the indexes used by the hot queries
+@app.on_event("startup")
+async def ensure_indexes():
+    """Create the MongoDB indexes needed by the API and drop retired ones (idempotent)"""
+    for collection_name, names in RETIRED_INDEXES.items():
+        existing = await db[collection_name].index_information()
+        for name in names:
+            if name in existing:
+                await db[collection_name].drop_index(name)
+                logging.info(f"Dropped retired index {name} on {collection_name}")
+    for collection_name, indexes in MONGO_INDEXES.items():
+        for index in indexes:
+            try:
+                await db[collection_name].create_indexes([index])
+            except OperationFailure as e:
+                # e.g. existing duplicates prevent a unique index; keep serving
+                logging.error(f"Could not create index {index.document['name']} on {collection_name}: {e}")
+
+# Store the derived fields on requests saved by older versions. Runs before
+# bootstrap_yearly_stats, which needs them, and only until it has completed once
+REQUEST_FIELDS_MIGRATION = "request_derived_fields"
+
+@app.on_event("startup")
+async def bootstrap_request_fields():
+    """Backfill absence interval, working days and per-year shares, then recount what they change"""
+    if await db.migrations.find_one({"_id": REQUEST_FIELDS_MIGRATION}):
+        return
+    result = await backfill_request_fields()
+    if result["updated"]:
+        logging.info(f"Derived fields stored on {result['updated']} existing requests")
+    if result["approved_found"]:
+        # Stats were attributed to the creation year until now
+        await rebuild_yearly_stats()
+    if result["affected_users"]:
+        # Approved ferie were counted in calendar days of the creation year until now
+        for user_id in result["affected_users"]:
+            first_allowance = await db.vacation_allowances.find_one({"user_id": user_id}, sort=[("year", 1)])
+            if first_allowance:
+                await recompute_vacation_allowances(user_id, first_allowance['year'])
+        logging.info(f"Vacation days recounted for {len(result['affected_users'])} users")
+    # Every request written from now on carries the fields: later boots skip the scan
+    await db.migrations.update_one(
+        {"_id": REQUEST_FIELDS_MIGRATION},
+        {"$set": {"applied_at": datetime.utcnow(), "updated": result["updated"]}},
+        upsert=True
+    )
+
+# Populate yearly_stats the first time the materialized stats are deployed
+@app.on_event("startup")
+async def bootstrap_yearly_stats():
+    """Build yearly_stats from existing requests if the collection is empty"""
+    if await db.yearly_stats.estimated_document_count() == 0:
+        report = await rebuild_yearly_stats()
+        logging.info(f"yearly_stats built for {report['checked']} user/year pairs")
+
+# Build the per-day absence counters the first time coverage checks are deployed
+@app.on_event("startup")
+async def bootstrap_absence_headcount():
+    """Build absence_headcount from approved requests if the collection is empty"""
+    if await db.absence_headcount.estimated_document_count() == 0:
+        days = await rebuild_absence_headcount()
+        if days:
+            logging.info(f"absence_headcount built for {days} days")
+
+# Start the email outbox dispatcher
+@app.on_event("startup")
+async def start_email_dispatcher():
+    """Start the background worker that drains the email outbox"""
+    global email_dispatcher_task, outbox_wakeup
+    # Bodies of messages delivered before they were redacted on completion
+    redacted = await db.email_outbox.update_many(
+        {"status": {"$in": ["sent", "failed"]}, "$or": [{"body": {"$ne": None}}, {"html_body": {"$ne": None}}]},
+        {"$set": EMAIL_BODY_REDACTED}
+    )
+    if redacted.modified_count:
+        logging.info(f"email_outbox: redacted {redacted.modified_count} delivered messages")
+    outbox_wakeup = asyncio.Event()
+    email_dispatcher_task = asyncio.create_task(run_email_dispatcher())
+
 # Authentication
 @api_router.post("/login")
 async def login(user_data: UserLogin):
     user = await db.users.find_one({"username": user_data.username, "is_active": True})
-    if not user or not verify_password(user_data.password, user['password_hash']):
+    if not user or not await verify_password(user_data.password, user['password_hash']):
         raise HTTPException(status_code=401, detail="Username o password non corretti")
     
     access_token = create_access_token(data={"sub": user['id'], "role": user['role']})
@@ -400,19 +1961,15 @@ async def login(user_data: UserLogin):
 @api_router.post("/admin/employees")
 async def create_employee(
     employee_data: UserCreate,
-    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user)
 ):
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Solo gli amministratori possono creare dipendenti")
     
-    # Check if username or email already exists
-    existing = await db.users.find_one({
-        "$or": [
-            {"username": employee_data.username},
-            {"email": employee_data.email}
-        ]
-    })
+    # Check if username or email already exists (emails case-insensitively, as the CSV import)
+    existing = await db.users.find_one({"username": employee_data.username}) or await db.users.find_one(
+        {"email": employee_data.email}, collation=EMAIL_COLLATION
+    )
     if existing:
         raise HTTPException(status_code=400, detail="Username o email già esistente")
     
@@ -420,45 +1977,37 @@ async def create_employee(
     employee = User(
         username=employee_data.username,
         email=employee_data.email,
-        password_hash=hash_password(employee_data.password),
+        password_hash=await hash_password(employee_data.password),
         role="employee"
     )
     
     await db.users.insert_one(employee.dict())
     
     # Send credentials email
-    subject = "Credenziali di accesso - Sistema Gestione Ferie"
-    body = f"""
-    Ciao {employee_data.username},
-    
-    È stato creato un account per te nel sistema di gestione ferie e permessi.
-    
-    Le tue credenziali di accesso sono:
-    Username: {employee_data.username}
-    Password: {employee_data.password}
-    
-    Puoi accedere al sistema utilizzando queste credenziali.
+    subject, body, html_body = credentials_email(employee_data.username, employee_data.password)
+    await enqueue_email(employee_data.email, subject, body, html_body, dedup_key=f"credentials:{employee.id}")
     
-    Cordiali saluti,
-    Amministrazione
-    """
+    return {"message": "Dipendente creato con successo", "employee_id": employee.id}
+
+# Admin bulk import of employees from CSV
+@api_router.post("/admin/employees/import")
+async def import_employees_csv(
+    file: UploadFile = File(...),
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Solo gli amministratori possono creare dipendenti")
     
-    html_body = f"""
-    <h2>Benvenuto nel Sistema Gestione Ferie</h2>
-    <p>Ciao <strong>{employee_data.username}</strong>,</p>
-    <p>È stato creato un account per te nel sistema di gestione ferie e permessi.</p>
-    <div style="background: #f5f5f5; padding: 15px; margin: 15px 0; border-radius: 5px;">
-        <h3>Le tue credenziali:</h3>
-        <p><strong>Username:</strong> {employee_data.username}</p>
-        <p><strong>Password:</strong> {employee_data.password}</p>
-    </div>
-    <p>Puoi accedere al sistema utilizzando queste credenziali.</p>
-    <p>Cordiali saluti,<br>Amministrazione</p>
-    """
+    try:
+        rows = read_employee_csv(await file.read())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if len(rows) > EMPLOYEE_IMPORT_MAX_ROWS:
+        raise HTTPException(status_code=400, detail=f"Massimo {EMPLOYEE_IMPORT_MAX_ROWS} righe per importazione")
     
-    background_tasks.add_task(send_email, employee_data.email, subject, body, html_body)
+    report = await import_employees(rows)
     
-    return {"message": "Dipendente creato con successo", "employee_id": employee.id}
+    return {"message": f"{report['created']} dipendenti creati", **report}
 
 # Get employees (admin only)
 @api_router.get("/admin/employees")
@@ -474,7 +2023,6 @@ async def get_employees(current_user: User = Depends(get_current_user)):
 @api_router.post("/requests")
 async def create_request(
     request_data: LeaveRequestCreate,
-    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user)
 ):
     if current_user.role != "employee":
@@ -501,7 +2049,18 @@ async def create_request(
             if hasattr(request_dict[field], 'isoformat'):
                 request_dict[field] = request_dict[field].isoformat()
     
+    # Absence interval and working days for calendar and stats queries
+    request_dict.update(derived_request_fields(request_dict))
+    
+    # Reject overlaps with the employee's own requests, flag days with too many colleagues away
+    conflicts = await find_request_conflicts(current_user.id, request_dict)
+    raise_on_overlap(conflicts)
+    request_dict['coverage_conflicts'] = conflicts["coverage_days"]
+    
     await db.requests.insert_one(request_dict)
+    invalidate_dashboard_cache()
+    publish_request_event("request_created", request_dict)
+    publish_dashboard_delta([(request_dict['type'], 1)])
     
     # Send notification to admin
     if email_settings.admin_email:
@@ -517,73 +2076,275 @@ async def create_request(
         Accedi al sistema per gestire la richiesta.
         """
         
-        background_tasks.add_task(send_email, email_settings.admin_email, subject, body)
+        if conflicts["coverage_days"]:
+            body += f"\n\nAttenzione: già {MAX_CONCURRENT_ABSENCES} o più dipendenti assenti nei giorni: {', '.join(conflicts['coverage_days'])}"
+        
+        await enqueue_email(email_settings.admin_email, subject, body, dedup_key=f"request-created:{request_obj.id}")
     
-    return {"message": "Richiesta creata con successo", "request_id": request_obj.id}
+    return {
+        "message": "Richiesta creata con successo",
+        "request_id": request_obj.id,
+        "coverage_conflicts": conflicts["coverage_days"]
+    }
 
 # Get user requests
 @api_router.get("/requests")
-async def get_user_requests(current_user: User = Depends(get_current_user)):
-    if current_user.role == "admin":
-        # Admin sees all requests
-        requests = await db.requests.find().sort("created_at", -1).to_list(1000)
-    else:
+async def get_user_requests(
+    response: Response,
+    request_status: Optional[str] = Query(None, alias="status"),
+    request_type: Optional[str] = Query(None, alias="type"),
+    user_id: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    fields: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(REQUESTS_PAGE_MAX_SIZE, ge=1, le=REQUESTS_PAGE_MAX_SIZE),
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != "admin":
         # Employee sees only their requests
-        requests = await db.requests.find({"user_id": current_user.id}).sort("created_at", -1).to_list(1000)
+        user_id = current_user.id
+    
+    query = build_requests_filter(user_id, request_status, request_type, date_from, date_to)
+    
+    # Keyset pagination: continue strictly after the last (created_at, id) seen
+    if cursor:
+        cursor_created_at, cursor_id = decode_requests_cursor(cursor)
+        query = {
+            "$and": [
+                query,
+                {
+                    "$or": [
+                        {"created_at": {"$lt": cursor_created_at}},
+                        {"created_at": cursor_created_at, "id": {"$lt": cursor_id}}
+                    ]
+                }
+            ]
+        }
+    
+    projection = build_requests_projection(fields)
+    
+    requests = await db.requests.find(query, projection).sort(
+        [("created_at", -1), ("id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
+    
+    # Tell the client where the next page starts instead of silently truncating
+    if len(requests) > limit:
+        requests = requests[:limit]
+        response.headers["X-Next-Cursor"] = encode_requests_cursor(requests[-1])
     
     # Clean up MongoDB ObjectId and convert to JSON-serializable format
     for req in requests:
         # Remove MongoDB's _id field if present
         if '_id' in req:
             del req['_id']
-        
-        # Add user info for admin view
-        if current_user.role == "admin":
-            user = await db.users.find_one({"id": req['user_id']})
-            if user:
-                req['username'] = user['username']
-                req['user_email'] = user['email']
+    
+    # Add user info for admin view
+    if current_user.role == "admin":
+        await attach_user_info(requests)
     
     return requests
 
+# Admin exports (streamed CSV)
+@api_router.get("/admin/export/requests")
+async def export_requests(
+    request_status: Optional[str] = Query(None, alias="status"),
+    request_type: Optional[str] = Query(None, alias="type"),
+    user_id: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Accesso negato")
+    
+    query = build_requests_filter(user_id, request_status, request_type, date_from, date_to)
+    cursor = db.requests.find(query, {"_id": 0}).sort([("created_at", -1), ("id", -1)])
+    return csv_download(stream_csv(cursor, REQUEST_EXPORT_COLUMNS, enrich=attach_user_info), "richieste.csv")
+
+@api_router.get("/admin/export/vacation-allowances")
+async def export_vacation_allowances(
+    year: Optional[int] = None,
+    user_id: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Accesso negato")
+    
+    query = {}
+    if year is not None:
+        query["year"] = year
+    if user_id:
+        query["user_id"] = user_id
+    cursor = db.vacation_allowances.find(query, {"_id": 0}).sort([("user_id", 1), ("year", 1)])
+    return csv_download(stream_csv(cursor, ALLOWANCE_EXPORT_COLUMNS, enrich=attach_employee_info), "ferie.csv")
+
+# Team absence calendar (admin only)
+@api_router.get("/admin/calendar")
+async def get_absence_calendar(
+    start: date,
+    end: date,
+    request_type: Optional[str] = Query(None, alias="type"),
+    include_pending: bool = False,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Accesso negato")
+    if end < start:
+        raise HTTPException(status_code=400, detail="La data di fine deve essere dopo la data di inizio")
+    if (end - start).days > CALENDAR_MAX_WINDOW_DAYS:
+        raise HTTPException(status_code=400, detail=f"Intervallo massimo {CALENDAR_MAX_WINDOW_DAYS} giorni")
+    
+    # Overlap test on the normalized interval. Absences of up to CALENDAR_SHORT_ABSENCE_DAYS
+    # start at most that many days before the window, which bounds the absence_start scan;
+    # longer sick leaves come from their partial index
+    window_start, window_end = datetime.combine(start, time.min), datetime.combine(end, time.min)
+    query = {
+        "$or": [
+            {
+                "absence_start": {
+                    "$gte": window_start - timedelta(days=CALENDAR_SHORT_ABSENCE_DAYS - 1),
+                    "$lte": window_end
+                },
+                "absence_end": {"$gte": window_start}
+            },
+            {
+                "sick_days": {"$gt": CALENDAR_SHORT_ABSENCE_DAYS},
+                "absence_end": {"$gte": window_start},
+                "absence_start": {"$lte": window_end}
+            }
+        ],
+        "status": {"$in": ["approved", "pending"]} if include_pending else "approved"
+    }
+    if request_type:
+        query["type"] = request_type
+    
+    absences = await db.requests.find(
+        query,
+        {"_id": 0, "id": 1, "user_id": 1, "type": 1, "status": 1, "absence_start": 1, "absence_end": 1}
+    ).sort("absence_start", 1).to_list(None)
+    await attach_user_info(absences)
+    
+    return [
+        {
+            "request_id": a['id'],
+            "user_id": a['user_id'],
+            "username": a.get('username'),
+            "type": a['type'],
+            "status": a['status'],
+            "start": a['absence_start'].date().isoformat(),
+            "end": a['absence_end'].date().isoformat()
+        }
+        for a in absences
+    ]
+
+def format_sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+# Live request events and dashboard deltas (Server-Sent Events)
+@api_router.post("/events/token")
+async def create_event_stream_token(current_user: User = Depends(get_current_user)):
+    """Token for GET /api/events: it ends up in URLs and access logs, so it only opens the stream and expires quickly"""
+    token = create_access_token(
+        data={"sub": current_user.id, "scope": "events"},
+        expires_delta=timedelta(seconds=EVENT_TOKEN_TTL_SECONDS)
+    )
+    return {"token": token, "expires_in": EVENT_TOKEN_TTL_SECONDS}
+
+@api_router.get("/events")
+async def stream_events(request: Request, current_user: User = Depends(get_event_stream_user)):
+    queue = event_broker.subscribe(current_user)
+    
+    async def event_stream():
+        try:
+            yield "retry: 3000\n" + format_sse("ready", {"role": current_user.role})
+            while True:
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=EVENT_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                if item is None:
+                    break
+                yield format_sse(*item)
+        finally:
+            event_broker.unsubscribe(queue)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # Admin dashboard stats
 @api_router.get("/admin/dashboard", response_model=DashboardStats)
 async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Accesso negato")
     
-    pending_ferie = await db.requests.count_documents({"type": "ferie", "status": "pending"})
-    pending_permessi = await db.requests.count_documents({"type": "permesso", "status": "pending"})
-    pending_malattie = await db.requests.count_documents({"type": "malattia", "status": "pending"})
+    if dashboard_cache["stats"] is not None and dashboard_cache["expires_at"] > monotonic():
+        return dashboard_cache["stats"]
+    
+    # Count pending requests per type in a single pass over the {status, type} index
+    pending_result = await db.requests.aggregate([
+        {"$match": {"status": "pending"}},
+        {"$group": {"_id": "$type", "count": {"$sum": 1}}}
+    ]).to_list(None)
+    pending_by_type = {item['_id']: item['count'] for item in pending_result}
     
-    return DashboardStats(
+    pending_ferie = pending_by_type.get("ferie", 0)
+    pending_permessi = pending_by_type.get("permesso", 0)
+    pending_malattie = pending_by_type.get("malattia", 0)
+    
+    stats = DashboardStats(
         pending_ferie=pending_ferie,
         pending_permessi=pending_permessi,
         pending_malattie=pending_malattie,
         total_pending=pending_ferie + pending_permessi + pending_malattie
     )
+    dashboard_cache["stats"] = stats
+    dashboard_cache["expires_at"] = monotonic() + DASHBOARD_CACHE_TTL_SECONDS
+    return stats
+
+# Email outbox metrics (admin only)
+@api_router.get("/admin/email-outbox/stats")
+async def get_email_outbox_stats(current_user: User = Depends(get_current_user)):
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Accesso negato")
+    
+    status_counts = await db.email_outbox.aggregate([
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ]).to_list(None)
+    by_status = {item['_id']: item['count'] for item in status_counts}
+    
+    oldest_pending = await db.email_outbox.find_one(
+        {"status": {"$in": ["pending", "sending"]}},
+        {"_id": 0, "created_at": 1},
+        sort=[("created_at", 1)]
+    )
+    oldest_pending_age = None
+    if oldest_pending:
+        oldest_pending_age = (datetime.utcnow() - oldest_pending['created_at']).total_seconds()
+    
+    return {
+        "queue_depth": by_status.get("pending", 0) + by_status.get("sending", 0),
+        "by_status": by_status,
+        "oldest_pending_age_seconds": oldest_pending_age,
+        "dispatcher": outbox_metrics
+    }
 
 # Admin respond to request
 @api_router.put("/admin/requests/{request_id}")
 async def respond_to_request(
     request_id: str,
     response: AdminResponse,
-    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user)
 ):
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Accesso negato")
     
-    # Find request
-    request_doc = await db.requests.find_one({"id": request_id})
-    if not request_doc:
-        raise HTTPException(status_code=404, detail="Richiesta non trovata")
-    
-    # Remove MongoDB's _id field if present
-    if '_id' in request_doc:
-        del request_doc['_id']
-    
-    # Update request
     status = "approved" if response.action == "approve" else "rejected"
     update_data = {
         "status": status,
@@ -591,10 +2352,36 @@ async def respond_to_request(
         "updated_at": datetime.utcnow()
     }
     
-    await db.requests.update_one({"id": request_id}, {"$set": update_data})
+    while True:
+        request_doc = await db.requests.find_one({"id": request_id}, {"_id": 0})
+        if not request_doc:
+            raise HTTPException(status_code=404, detail="Richiesta non trovata")
+        
+        # Make sure the allowance exists before the status changes, so its initial
+        # used days can never already include this transition
+        allowance_versions = await ensure_vacation_allowances([request_doc])
+        
+        # Swap the status atomically, only if it is still the one read; the transition is
+        # built from the document as it was replaced, with any dates edited meanwhile
+        previous_doc = await db.requests.find_one_and_update(
+            {"id": request_id, "status": request_doc.get('status')}, {"$set": update_data}, projection={"_id": 0}
+        )
+        if previous_doc:
+            break
+    
+    invalidate_dashboard_cache()
+    request_doc = {**previous_doc, **update_data}
+    previous_status = previous_doc.get('status', 'pending')
+    publish_request_event("request_status", request_doc)
+    if previous_status == "pending":
+        publish_dashboard_delta([(request_doc['type'], -1)])
+    
+    transitions = [(previous_doc, previous_status, status)]
+    await update_yearly_stats_on_status_changes(transitions)
+    await update_absence_headcount_on_status_changes(transitions)
     
-    # Recalculate vacation allowances if it's a vacation request
-    await update_vacation_on_request_change(request_doc['user_id'], request_doc['type'])
+    # Debit or credit the vacation balance if it's a vacation request
+    await apply_vacation_ledger_entries(transitions, allowance_versions)
     
     # Send notification to employee
     user = await db.users.find_one({"id": request_doc['user_id']})
@@ -616,10 +2403,108 @@ async def respond_to_request(
         
         body += "\n\nCordiali saluti,\nAmministrazione"
         
-        background_tasks.add_task(send_email, user['email'], subject, body)
+        await enqueue_email(user['email'], subject, body)
     
     return {"message": f"Richiesta {status} con successo"}
 
+def describe_request(request_doc: dict) -> str:
+    """One line summary of a request for notification emails"""
+    absence_start, absence_end = absence_range(request_doc)
+    if not absence_start:
+        return request_doc['type']
+    if absence_start == absence_end:
+        return f"{request_doc['type']} del {absence_start.strftime('%d/%m/%Y')}"
+    return f"{request_doc['type']} dal {absence_start.strftime('%d/%m/%Y')} al {absence_end.strftime('%d/%m/%Y')}"
+
+# Admin bulk respond to requests
+@api_router.post("/admin/requests/bulk")
+async def bulk_respond_to_requests(
+    response: BulkAdminResponse,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Accesso negato")
+    
+    status = "approved" if response.action == "approve" else "rejected"
+    request_docs = await db.requests.find({"id": {"$in": response.request_ids}}, {"_id": 0}).to_list(None)
+    found_ids = {doc['id'] for doc in request_docs}
+    not_found = [request_id for request_id in response.request_ids if request_id not in found_ids]
+    
+    to_change = [doc for doc in request_docs if doc.get('status', 'pending') != status]
+    unchanged = [doc['id'] for doc in request_docs if doc.get('status', 'pending') == status]
+    if not to_change:
+        return {"message": "Nessuna richiesta da aggiornare", "updated": 0, "unchanged": unchanged, "not_found": not_found}
+    
+    allowance_versions = await ensure_vacation_allowances(to_change)
+    
+    # One bulk_write; each update only applies if the status is still the one read above,
+    # and response_id marks the requests this call actually changed
+    response_id = str(uuid.uuid4())
+    update_data = {
+        "status": status,
+        "admin_notes": response.notes,
+        "updated_at": datetime.utcnow(),
+        "response_id": response_id
+    }
+    result = await db.requests.bulk_write([
+        UpdateOne({"id": doc['id'], "status": doc.get('status')}, {"$set": update_data})
+        for doc in to_change
+    ], ordered=False)
+    invalidate_dashboard_cache()
+    
+    # Re-read what this call changed: requests answered concurrently are left out, and
+    # dates edited by the employee between the read above and the write are picked up
+    previous_status = {doc['id']: doc.get('status', 'pending') for doc in to_change}
+    changed = await db.requests.find(
+        {"id": {"$in": list(previous_status)}, "response_id": response_id}, {"_id": 0}
+    ).to_list(None) if result.modified_count else []
+    changed_ids = {doc['id'] for doc in changed}
+    unchanged += [request_id for request_id in previous_status if request_id not in changed_ids]
+    to_change = changed
+    
+    for doc in to_change:
+        publish_request_event("request_status", doc)
+    publish_dashboard_delta([(doc['type'], -1) for doc in to_change if previous_status[doc['id']] == "pending"])
+    
+    transitions = [(doc, previous_status[doc['id']], status) for doc in to_change]
+    await update_yearly_stats_on_status_changes(transitions)
+    await update_absence_headcount_on_status_changes(transitions)
+    await apply_vacation_ledger_entries(transitions, allowance_versions)
+    
+    # One notification per employee listing all their answered requests
+    requests_by_user: Dict[str, List[dict]] = {}
+    for doc in to_change:
+        requests_by_user.setdefault(doc['user_id'], []).append(doc)
+    users = await db.users.find(
+        {"id": {"$in": list(requests_by_user)}}, {"_id": 0, "id": 1, "username": 1, "email": 1}
+    ).to_list(None)
+    
+    action_text = "approvate" if status == "approved" else "rifiutate"
+    messages = []
+    for user in users:
+        lines = "\n".join(f"        - {describe_request(doc)}" for doc in requests_by_user[user['id']])
+        body = f"""
+        Ciao {user['username']},
+        
+        Le seguenti richieste sono state {action_text}:
+{lines}
+        """
+        
+        if response.notes:
+            body += f"\n\nNote dell'amministratore:\n{response.notes}"
+        
+        body += "\n\nCordiali saluti,\nAmministrazione"
+        
+        messages.append({"to_email": user['email'], "subject": f"Richieste {action_text}", "body": body})
+    await enqueue_emails(messages)
+    
+    return {
+        "message": f"{len(to_change)} richieste {action_text}",
+        "updated": len(to_change),
+        "unchanged": unchanged,
+        "not_found": not_found
+    }
+
 # Admin settings - Change email
 @api_router.put("/admin/settings")
 async def update_admin_settings(
@@ -634,6 +2519,7 @@ async def update_admin_settings(
         {"id": current_user.id},
         {"$set": {"email": settings.email}}
     )
+    user_cache.invalidate(current_user.id)
     
     return {"message": "Impostazioni aggiornate con successo"}
 
@@ -675,11 +2561,21 @@ async def update_request(
             if hasattr(request_dict[field], 'isoformat'):
                 request_dict[field] = request_dict[field].isoformat()
     
-    # Update the request
+    request_dict.update(derived_request_fields(request_dict))
+    conflicts = await find_request_conflicts(current_user.id, request_dict, exclude_id=request_id)
+    raise_on_overlap(conflicts)
+    request_dict['coverage_conflicts'] = conflicts["coverage_days"]
+    
+    # Update the request, unless an admin handled it since it was read
     request_dict['updated_at'] = datetime.utcnow()
-    await db.requests.update_one({"id": request_id}, {"$set": request_dict})
+    result = await db.requests.update_one({"id": request_id, "status": "pending"}, {"$set": request_dict})
+    if result.matched_count == 0:
+        raise HTTPException(status_code=400, detail="Non puoi modificare una richiesta già elaborata")
+    invalidate_dashboard_cache()
+    publish_request_event("request_updated", request_dict)
+    publish_dashboard_delta([(existing_request['type'], -1), (request_dict['type'], 1)])
     
-    return {"message": "Richiesta modificata con successo"}
+    return {"message": "Richiesta modificata con successo", "coverage_conflicts": conflicts["coverage_days"]}
 
 # Employee delete request (only if pending)
 @api_router.delete("/requests/{request_id}")
@@ -699,8 +2595,13 @@ async def delete_request(
     if existing_request.get('status', 'pending') != 'pending':
         raise HTTPException(status_code=400, detail="Non puoi cancellare una richiesta già elaborata")
     
-    # Delete the request
-    await db.requests.delete_one({"id": request_id})
+    # Delete the request, unless an admin handled it since it was read
+    result = await db.requests.delete_one({"id": request_id, "status": "pending"})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=400, detail="Non puoi cancellare una richiesta già elaborata")
+    invalidate_dashboard_cache()
+    publish_request_event("request_deleted", existing_request)
+    publish_dashboard_delta([(existing_request['type'], -1)])
     
     return {"message": "Richiesta cancellata con successo"}
 
@@ -719,62 +2620,7 @@ async def get_employee_stats(
     if not employee:
         raise HTTPException(status_code=404, detail="Dipendente non trovato")
     
-    # Get all approved requests for the employee in the specified year
-    start_date = datetime(year, 1, 1)
-    end_date = datetime(year, 12, 31, 23, 59, 59)
-    
-    pipeline = [
-        {
-            "$match": {
-                "user_id": employee_id,
-                "status": "approved",
-                "created_at": {
-                    "$gte": start_date,
-                    "$lte": end_date
-                }
-            }
-        },
-        {
-            "$group": {
-                "_id": "$type",
-                "count": {"$sum": 1},
-                "days": {
-                    "$sum": {
-                        "$switch": {
-                            "branches": [
-                                {"case": {"$eq": ["$type", "ferie"]}, "then": {"$add": [{"$subtract": [{"$dateFromString": {"dateString": "$end_date"}}, {"$dateFromString": {"dateString": "$start_date"}}]}, 86400000]}},
-                                {"case": {"$eq": ["$type", "malattia"]}, "then": "$sick_days"}
-                            ],
-                            "default": 0
-                        }
-                    }
-                }
-            }
-        }
-    ]
-    
-    # Simplified approach - get all requests and calculate in Python
-    requests = await db.requests.find({
-        "user_id": employee_id,
-        "status": "approved",
-        "created_at": {"$gte": start_date, "$lte": end_date}
-    }).to_list(None)
-    
-    ferie_days = 0
-    permessi_count = 0
-    malattie_days = 0
-    
-    for req in requests:
-        if req['type'] == 'ferie':
-            # Calculate days between start_date and end_date
-            if req.get('start_date') and req.get('end_date'):
-                start = datetime.fromisoformat(req['start_date']) if isinstance(req['start_date'], str) else req['start_date']
-                end = datetime.fromisoformat(req['end_date']) if isinstance(req['end_date'], str) else req['end_date']
-                ferie_days += (end - start).days + 1
-        elif req['type'] == 'permesso':
-            permessi_count += 1
-        elif req['type'] == 'malattia':
-            malattie_days += req.get('sick_days', 0)
+    stats = await get_yearly_stats(employee_id, year)
     
     return {
         "employee": {
@@ -783,12 +2629,7 @@ async def get_employee_stats(
             "email": employee['email']
         },
         "year": year,
-        "stats": {
-            "ferie_days": ferie_days,
-            "permessi_count": permessi_count,
-            "malattie_days": malattie_days,
-            "total_requests": len(requests)
-        }
+        "stats": stats.dict(exclude={"year"})
     }
 
 # Get available years for employee stats
@@ -801,14 +2642,7 @@ async def get_employee_years(
         raise HTTPException(status_code=403, detail="Accesso negato")
     
     # Get all years where the employee has requests
-    pipeline = [
-        {"$match": {"user_id": employee_id}},
-        {"$group": {"_id": {"$year": "$created_at"}}},
-        {"$sort": {"_id": -1}}
-    ]
-    
-    years_result = await db.requests.aggregate(pipeline).to_list(None)
-    years = [item['_id'] for item in years_result]
+    years = await db.requests.distinct("days_by_year.year", {"user_id": employee_id})
     
     # Always include current year
     current_year = datetime.now().year
@@ -826,39 +2660,11 @@ async def get_personal_stats(
     if current_user.role != "employee":
         raise HTTPException(status_code=403, detail="Solo i dipendenti possono vedere le proprie statistiche")
     
-    # Get all approved requests for the current user in the specified year
-    start_date = datetime(year, 1, 1)
-    end_date = datetime(year, 12, 31, 23, 59, 59)
-    
-    requests = await db.requests.find({
-        "user_id": current_user.id,
-        "status": "approved",
-        "created_at": {"$gte": start_date, "$lte": end_date}
-    }).to_list(None)
-    
-    ferie_days = 0
-    permessi_count = 0
-    malattie_days = 0
-    
-    for req in requests:
-        if req['type'] == 'ferie':
-            if req.get('start_date') and req.get('end_date'):
-                start = datetime.fromisoformat(req['start_date']) if isinstance(req['start_date'], str) else req['start_date']
-                end = datetime.fromisoformat(req['end_date']) if isinstance(req['end_date'], str) else req['end_date']
-                ferie_days += (end - start).days + 1
-        elif req['type'] == 'permesso':
-            permessi_count += 1
-        elif req['type'] == 'malattia':
-            malattie_days += req.get('sick_days', 0)
+    stats = await get_yearly_stats(current_user.id, year)
     
     return {
         "year": year,
-        "stats": {
-            "ferie_days": ferie_days,
-            "permessi_count": permessi_count,
-            "malattie_days": malattie_days,
-            "total_requests": len(requests)
-        }
+        "stats": stats.dict(exclude={"year"})
     }
 
 # Get available years for personal stats
@@ -868,14 +2674,7 @@ async def get_personal_years(current_user: User = Depends(get_current_user)):
         raise HTTPException(status_code=403, detail="Solo i dipendenti possono vedere le proprie statistiche")
     
     # Get all years where the user has requests
-    pipeline = [
-        {"$match": {"user_id": current_user.id}},
-        {"$group": {"_id": {"$year": "$created_at"}}},
-        {"$sort": {"_id": -1}}
-    ]
-    
-    years_result = await db.requests.aggregate(pipeline).to_list(None)
-    years = [item['_id'] for item in years_result]
+    years = await db.requests.distinct("days_by_year.year", {"user_id": current_user.id})
     
     # Always include current year
     current_year = datetime.now().year
@@ -953,31 +2752,101 @@ async def update_vacation_allowance(
         raise HTTPException(status_code=400, detail="Giorni massimi devono essere tra 0 e 50")
     
     # Get or create allowance
-    allowance = await get_or_create_vacation_allowance(employee_id, year, max_days)
+    await get_or_create_vacation_allowance(employee_id, year, max_days)
     
-    # Update max days
-    await db.vacation_allowances.update_one(
-        {"user_id": employee_id, "year": year},
-        {
-            "$set": {
-                "max_days": max_days,
-                "updated_at": datetime.utcnow()
-            }
-        }
-    )
+    # Apply the new max days and recompute the carry-over chain of the following years
+    await recompute_vacation_allowances(employee_id, year, max_days=max_days)
+    
+    return {"message": "Giorni ferie aggiornati con successo"}
+
+@api_router.get("/admin/vacation-balances")
+async def get_vacation_balances(
+    year: int = datetime.now().year,
+    search: Optional[str] = None,
+    is_active: Optional[bool] = None,
+    min_remaining: Optional[int] = None,
+    max_remaining: Optional[int] = None,
+    page: int = Query(1, ge=1),
+    limit: int = Query(100, ge=1, le=500),
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Accesso negato")
+    
+    match = {"role": "employee"}
+    if search:
+        match["username"] = {"$regex": f"^{re.escape(search)}", "$options": "i"}
+    if is_active is not None:
+        match["is_active"] = is_active
+    
+    # Join every employee with their allowances: the requested year plus the total still available
+    join_allowances = [
+        {"$lookup": {"from": "vacation_allowances", "localField": "id", "foreignField": "user_id", "as": "allowances"}},
+        {"$project": {
+            "_id": 0,
+            "employee": {"id": "$id", "username": "$username", "email": "$email", "is_active": "$is_active"},
+            "allowance": {"$arrayElemAt": [
+                {"$filter": {"input": "$allowances", "as": "a", "cond": {"$eq": ["$$a.year", year]}}}, 0
+            ]},
+            "total_remaining_days": {"$sum": {
+                "$map": {"input": "$allowances", "as": "a", "in": {"$max": [0, "$$a.remaining_days"]}}
+            }}
+        }}
+    ]
+    page_items = [{"$skip": (page - 1) * limit}, {"$limit": limit}]
+    
+    pipeline = [{"$match": match}, {"$sort": {"username": 1}}]
+    if min_remaining is not None or max_remaining is not None:
+        # Balance filters need the join first
+        remaining_filter = {}
+        if min_remaining is not None:
+            remaining_filter["$gte"] = min_remaining
+        if max_remaining is not None:
+            remaining_filter["$lte"] = max_remaining
+        pipeline += join_allowances + [
+            {"$match": {"allowance.remaining_days": remaining_filter}},
+            {"$facet": {"items": page_items, "total": [{"$count": "count"}]}}
+        ]
+    else:
+        # Otherwise only the employees of the requested page are joined
+        pipeline.append({"$facet": {"items": page_items + join_allowances, "total": [{"$count": "count"}]}})
     
-    # Recalculate all affected years
-    await recalculate_vacation_allowance(employee_id, year)
+    result = (await db.users.aggregate(pipeline).to_list(1))[0]
     
-    # If this is not the current year, recalculate subsequent years
-    current_year = datetime.now().year
-    if year < current_year:
-        for future_year in range(year + 1, current_year + 1):
-            future_allowance = await db.vacation_allowances.find_one({"user_id": employee_id, "year": future_year})
-            if future_allowance:
-                await recalculate_vacation_allowance(employee_id, future_year)
+    items = []
+    for item in result['items']:
+        allowance = item.get('allowance') or {}
+        items.append({
+            "employee": item['employee'],
+            "year": year,
+            "max_days": allowance.get('max_days'),
+            "used_days": allowance.get('used_days'),
+            "carried_over_days": allowance.get('carried_over_days'),
+            "remaining_days": allowance.get('remaining_days'),
+            "total_remaining_days": item['total_remaining_days']
+        })
     
-    return {"message": "Giorni ferie aggiornati con successo"}
+    return {
+        "year": year,
+        "page": page,
+        "limit": limit,
+        "total": result['total'][0]['count'] if result['total'] else 0,
+        "items": items
+    }
+
+@api_router.post("/admin/vacation-allowances/rollover")
+async def rollover_vacation_year(
+    rollover: VacationRollover,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Accesso negato")
+    
+    def log_progress(done: int, total: int):
+        logging.info(f"Vacation rollover {rollover.year}: {done}/{total} employees")
+    
+    result = await rollover_vacation_allowances(rollover.year, rollover.max_days, progress=log_progress)
+    return {"message": "Ferie dell'anno create con successo", **result}
 
 @api_router.get("/vacation-summary")
 async def get_personal_vacation_summary(current_user: User = Depends(get_current_user)):
@@ -1018,40 +2887,6 @@ async def get_personal_vacation_summary(current_user: User = Depends(get_current
         ]
     }
 
-# Automatically recalculate vacation allowances when vacation requests are approved/rejected
-async def update_vacation_on_request_change(user_id: str, request_type: str):
-    """Update vacation allowances when requests change"""
-    if request_type != "ferie":
-        return
-    
-    # Get all years that might be affected
-    current_year = datetime.now().year
-    years_to_update = []
-    
-    # Find all years with vacation requests for this user
-    pipeline = [
-        {"$match": {"user_id": user_id, "type": "ferie", "status": "approved"}},
-        {"$group": {"_id": {"$year": "$created_at"}}},
-    ]
-    
-    years_result = await db.requests.aggregate(pipeline).to_list(None)
-    request_years = [item['_id'] for item in years_result]
-    
-    # Always include current year
-    request_years.append(current_year)
-    years_to_update = sorted(set(request_years))
-    
-    # Recalculate each year
-    for year in years_to_update:
-        await recalculate_vacation_allowance(user_id, year)
-
-class YearlyStats(BaseModel):
-    year: int
-    ferie_days: int
-    permessi_count: int
-    malattie_days: int
-    total_requests: int
-
 class VacationAllowance(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
@@ -1060,6 +2895,7 @@ class VacationAllowance(BaseModel):
     used_days: int = 0  # Giorni utilizzati
     carried_over_days: int = 0  # Giorni riportati dall'anno precedente
     remaining_days: int = 20  # Giorni rimanenti (max_days + carried_over - used_days)
+    version: int = 0  # Incrementato ad ogni modifica (concorrenza ottimistica)
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: Optional[datetime] = None
 
@@ -1096,19 +2932,37 @@ async def change_password(
     
     # Verify current password
     user_doc = await db.users.find_one({"id": current_user.id})
-    if not verify_password(current_password, user_doc['password_hash']):
+    if not await verify_password(current_password, user_doc['password_hash']):
         raise HTTPException(status_code=400, detail="Password corrente non corretta")
     
     # Update password
-    new_hash = hash_password(new_password)
+    new_hash = await hash_password(new_password)
     await db.users.update_one(
         {"id": current_user.id},
         {"$set": {"password_hash": new_hash}}
     )
+    user_cache.invalidate(current_user.id)
     
     return {"message": "Password cambiata con successo"}
 
 # Include the router in the main app
+# Prometheus metrics (outside /api, where scrapers expect them)
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics(request: Request):
+    if METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Token invalido")
+    
+    lines = []
+    for histogram in (http_request_duration, http_request_db_calls, http_request_db_duration, mongodb_command_duration):
+        lines.extend(histogram.render())
+    
+    lines += ["# HELP event_stream_subscribers Open event streams", "# TYPE event_stream_subscribers gauge",
+              f"event_stream_subscribers {event_broker.subscriber_count}"]
+    for key in ("enqueued", "deduplicated", "sent", "retried", "failed"):
+        lines += [f"# TYPE email_outbox_{key}_total counter", f"email_outbox_{key}_total {outbox_metrics[key]}"]
+    
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
 app.include_router(api_router)
 
 app.add_middleware(
@@ -1117,8 +2971,11 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Server-Timing"],
 )
 
+app.add_middleware(RequestMetricsMiddleware)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -1128,7 +2985,11 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    if email_dispatcher_task is not None:
+        email_dispatcher_task.cancel()
+    await mailer.close()
     client.close()
+    password_executor.shutdown(wait=False)
     import os
 # ... altro codice ...
 
@@ -0,0 +1,78 @@
+"""
+Italian working-day calendar for Sistema Gestione Ferie e Permessi.
+
+Working days are Monday to Friday, excluding the national public holidays
+(including Easter Monday). Each year's calendar is computed once and kept as
+a prefix-sum table, so counting the working days between two dates costs a
+couple of lookups per calendar year spanned.
+"""
+
+from datetime import date, timedelta
+from functools import lru_cache
+from typing import FrozenSet, Tuple
+
+# National holidays with a fixed date (month, day)
+FIXED_HOLIDAYS = [
+    (1, 1),    # Capodanno
+    (1, 6),    # Epifania
+    (4, 25),   # Festa della Liberazione
+    (5, 1),    # Festa dei Lavoratori
+    (6, 2),    # Festa della Repubblica
+    (8, 15),   # Ferragosto
+    (11, 1),   # Ognissanti
+    (12, 8),   # Immacolata Concezione
+    (12, 25),  # Natale
+    (12, 26),  # Santo Stefano
+]
+
+
+def easter_sunday(year: int) -> date:
+    """Gregorian Easter Sunday (anonymous Gregorian algorithm)"""
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    weekday_offset = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * weekday_offset) // 451
+    month, day = divmod(h + weekday_offset - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+@lru_cache(maxsize=None)
+def public_holidays(year: int) -> FrozenSet[date]:
+    """National public holidays of a year, Easter Monday included"""
+    holidays = {date(year, month, day) for month, day in FIXED_HOLIDAYS}
+    holidays.add(easter_sunday(year) + timedelta(days=1))
+    return frozenset(holidays)
+
+
+def is_working_day(day: date) -> bool:
+    return day.weekday() < 5 and day not in public_holidays(day.year)
+
+
+@lru_cache(maxsize=None)
+def _working_day_prefix(year: int) -> Tuple[int, ...]:
+    """prefix[n] = working days among the first n days of the year"""
+    prefix = [0]
+    day = date(year, 1, 1)
+    while day.year == year:
+        prefix.append(prefix[-1] + is_working_day(day))
+        day += timedelta(days=1)
+    return tuple(prefix)
+
+
+def working_days_between(start: date, end: date) -> int:
+    """Working days from start to end, both included (0 if end is before start)"""
+    if end < start:
+        return 0
+
+    total = 0
+    for year in range(start.year, end.year + 1):
+        prefix = _working_day_prefix(year)
+        first = start.timetuple().tm_yday if year == start.year else 1
+        last = end.timetuple().tm_yday if year == end.year else len(prefix) - 1
+        total += prefix[last] - prefix[first - 1]
+    return total
@@ -0,0 +1,315 @@
+"""
+Load test and benchmark for the Sistema Gestione Ferie e Permessi API.
+
+Boots backend/server.py with uvicorn on a throwaway database, seeds
+synthetic employees x years x requests through the API, then drives
+concurrent load on the hot endpoints and reports p50/p95/p99 latency and
+throughput per scenario. With --baseline the run fails when a scenario
+is slower than the stored results beyond the tolerance.
+
+    python benchmarks/load_test.py --employees 50 --years 3 --requests-per-year 20
+    python benchmarks/load_test.py --in-memory                 # mongomock-motor, no MongoDB needed
+    python benchmarks/load_test.py --save-baseline benchmarks/baseline.json
+    python benchmarks/load_test.py --baseline benchmarks/baseline.json --tolerance 0.25
+"""
+
+import csv
+import io
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import requests
+import typer
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+BACKEND_DIR = BENCHMARK_DIR.parent / "backend"
+
+ADMIN_USERNAME = "admin"
+ADMIN_PASSWORD = "admin123"
+EMPLOYEE_PASSWORD = "benchmark-pass"
+
+cli = typer.Typer()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int, mongo_url: str, db_name: str, in_memory: bool) -> subprocess.Popen:
+    """Start the API in its own process, so the load generator does not share its CPU time"""
+    env = {
+        **os.environ,
+        "MONGO_URL": mongo_url,
+        "DB_NAME": db_name,
+        # No notification goes out: admin emails are skipped, credential emails fail fast on a closed port
+        "ADMIN_EMAIL": "",
+        "SMTP_SERVER": "127.0.0.1",
+        "SMTP_PORT": "9",
+        "SMTP_USE_TLS": "false",
+    }
+    if in_memory:
+        command = [sys.executable, str(BENCHMARK_DIR / "memory_server.py"), str(port)]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1",
+                   "--port", str(port), "--log-level", "warning"]
+    return subprocess.Popen(command, cwd=BACKEND_DIR, env=env)
+
+
+def wait_until_ready(base_url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"API exited during startup with code {process.returncode}")
+        try:
+            if requests.get(f"{base_url}/api/", timeout=1).status_code == 200:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("API not ready in time")
+
+
+def login(base_url: str, username: str, password: str) -> dict:
+    response = requests.post(f"{base_url}/api/login", json={"username": username, "password": password})
+    response.raise_for_status()
+    return response.json()
+
+
+def leave_request_for_week(year: int, week: int) -> dict:
+    """A ferie, permesso or malattia request in its own week, so no two requests overlap"""
+    first_monday = date(year, 1, 1) + timedelta(days=(7 - date(year, 1, 1).weekday()) % 7)
+    monday = first_monday + timedelta(weeks=week)
+    kind = week % 3
+    if kind == 0:
+        return {"type": "ferie", "start_date": (monday + timedelta(days=1)).isoformat(),
+                "end_date": (monday + timedelta(days=3)).isoformat()}
+    if kind == 1:
+        return {"type": "permesso", "permit_date": (monday + timedelta(days=4)).isoformat(),
+                "start_time": "09:00", "end_time": "11:00"}
+    return {"type": "malattia", "sick_start_date": monday.isoformat(), "sick_days": 1,
+            "protocol_code": f"BENCH{year}{week:02d}"}
+
+
+def seed(base_url: str, admin_token: str, employees: int, years: int, requests_per_year: int,
+         workers: int) -> List[dict]:
+    """Create employees, their requests and approvals through the API; return the employees' logins"""
+    admin_headers = {"Authorization": f"Bearer {admin_token}"}
+
+    rows = io.StringIO()
+    writer = csv.writer(rows)
+    writer.writerow(["username", "email", "password"])
+    for i in range(employees):
+        writer.writerow([f"bench{i:05d}", f"bench{i:05d}@benchmark-company.com", EMPLOYEE_PASSWORD])
+    response = requests.post(
+        f"{base_url}/api/admin/employees/import",
+        files={"file": ("employees.csv", rows.getvalue().encode(), "text/csv")},
+        headers=admin_headers,
+    )
+    response.raise_for_status()
+    if response.json()["errors"]:
+        raise RuntimeError(f"Employee import failed: {response.json()['errors'][:3]}")
+
+    with ThreadPoolExecutor(workers) as pool:
+        logins = list(pool.map(lambda i: login(base_url, f"bench{i:05d}", EMPLOYEE_PASSWORD), range(employees)))
+
+    current_year = datetime.now().year
+    seed_years = range(current_year - years + 1, current_year + 1)
+
+    def create_requests(employee_login: dict) -> List[str]:
+        session = requests.Session()
+        session.headers["Authorization"] = f"Bearer {employee_login['access_token']}"
+        request_ids = []
+        for year in seed_years:
+            for week in range(requests_per_year):
+                response = session.post(f"{base_url}/api/requests", json=leave_request_for_week(year, week))
+                response.raise_for_status()
+                request_ids.append(response.json()["request_id"])
+        return request_ids
+
+    with ThreadPoolExecutor(workers) as pool:
+        request_ids = [request_id for ids in pool.map(create_requests, logins) for request_id in ids]
+
+    # 70% approved, 10% rejected, the rest left pending
+    approved = request_ids[:int(len(request_ids) * 0.7)]
+    rejected = request_ids[len(approved):len(approved) + int(len(request_ids) * 0.1)]
+    for action, ids in (("approve", approved), ("reject", rejected)):
+        for offset in range(0, len(ids), 1000):
+            response = requests.post(
+                f"{base_url}/api/admin/requests/bulk",
+                json={"request_ids": ids[offset:offset + 1000], "action": action},
+                headers=admin_headers,
+            )
+            response.raise_for_status()
+
+    return logins
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Nearest-rank percentile"""
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def run_scenario(call: Callable[[requests.Session, int], requests.Response], total: int,
+                 concurrency: int, warmup: int) -> dict:
+    """Issue total calls from concurrency threads and summarise their latency"""
+    local = threading.local()
+
+    def session() -> requests.Session:
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return local.session
+
+    for i in range(warmup):
+        call(session(), i)
+
+    def timed(i: int):
+        started = time.perf_counter()
+        response = call(session(), i)
+        return time.perf_counter() - started, response.status_code
+
+    wall_started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(timed, range(total)))
+    wall = time.perf_counter() - wall_started
+
+    latencies = sorted(elapsed for elapsed, _ in results)
+    return {
+        "requests": total,
+        "errors": sum(1 for _, status_code in results if status_code >= 400),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "throughput_rps": round(total / wall, 1),
+    }
+
+
+def build_scenarios(base_url: str, admin_token: str, logins: List[dict], year: int) -> Dict[str, tuple]:
+    """Scenario name -> (call, share of the configured request count)"""
+    admin_headers = {"Authorization": f"Bearer {admin_token}"}
+
+    def employee(i: int) -> dict:
+        return logins[i % len(logins)]
+
+    def employee_headers(i: int) -> dict:
+        return {"Authorization": f"Bearer {employee(i)['access_token']}"}
+
+    return {
+        # bcrypt bound: a fraction of the other scenarios is enough
+        "login": (lambda s, i: s.post(f"{base_url}/api/login", json={
+            "username": employee(i)["user"]["username"], "password": EMPLOYEE_PASSWORD}), 0.25),
+        "list_requests_employee": (lambda s, i: s.get(
+            f"{base_url}/api/requests", params={"limit": 50}, headers=employee_headers(i)), 1),
+        "list_requests_admin": (lambda s, i: s.get(
+            f"{base_url}/api/requests", params={"limit": 100}, headers=admin_headers), 1),
+        "dashboard": (lambda s, i: s.get(f"{base_url}/api/admin/dashboard", headers=admin_headers), 1),
+        "stats_employee": (lambda s, i: s.get(
+            f"{base_url}/api/stats", params={"year": year}, headers=employee_headers(i)), 1),
+        "stats_admin": (lambda s, i: s.get(
+            f"{base_url}/api/admin/employees/{employee(i)['user']['id']}/stats",
+            params={"year": year}, headers=admin_headers), 1),
+        "vacation_summary": (lambda s, i: s.get(f"{base_url}/api/vacation-summary", headers=employee_headers(i)), 1),
+    }
+
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Scenarios whose p95 latency or throughput regressed beyond the tolerance"""
+    regressions = []
+    for name, base in baseline.get("scenarios", {}).items():
+        current = results["scenarios"].get(name)
+        if current is None:
+            continue
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {current['p95_ms']}ms vs baseline {base['p95_ms']}ms")
+        if current["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: throughput {current['throughput_rps']}/s vs baseline {base['throughput_rps']}/s")
+    return regressions
+
+
+@cli.command()
+def main(
+    mongo_url: str = typer.Option(os.environ.get("MONGO_URL", "mongodb://localhost:27017"), help="MongoDB da usare"),
+    in_memory: bool = typer.Option(False, "--in-memory", help="Usa mongomock-motor al posto di MongoDB"),
+    employees: int = typer.Option(50, min=1, help="Dipendenti da creare"),
+    years: int = typer.Option(3, min=1, help="Anni di richieste per dipendente"),
+    requests_per_year: int = typer.Option(20, min=1, max=50, help="Richieste per dipendente e anno"),
+    requests_per_scenario: int = typer.Option(200, "--requests", min=1, help="Richieste misurate per scenario"),
+    concurrency: int = typer.Option(10, min=1, help="Client concorrenti"),
+    warmup: int = typer.Option(10, min=0, help="Richieste di riscaldamento per scenario (non misurate)"),
+    scenario: Optional[List[str]] = typer.Option(None, help="Esegui solo questi scenari"),
+    output: Optional[Path] = typer.Option(None, help="Scrivi i risultati in JSON"),
+    baseline: Optional[Path] = typer.Option(None, help="Fallisci se peggiore di questi risultati"),
+    save_baseline: Optional[Path] = typer.Option(None, help="Salva i risultati come nuova baseline"),
+    tolerance: float = typer.Option(0.2, min=0, help="Peggioramento ammesso rispetto alla baseline (0.2 = 20%)"),
+    keep_data: bool = typer.Option(False, "--keep-data", help="Non cancellare il database di benchmark"),
+):
+    """Seed a throwaway database, load the API and report latency percentiles"""
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    db_name = f"leave_benchmark_{uuid.uuid4().hex[:8]}"
+    process = start_server(port, mongo_url, db_name, in_memory)
+    try:
+        wait_until_ready(base_url, process)
+        admin_token = login(base_url, ADMIN_USERNAME, ADMIN_PASSWORD)["access_token"]
+
+        started = time.perf_counter()
+        logins = seed(base_url, admin_token, employees, years, requests_per_year, workers=concurrency)
+        typer.echo(f"Seeded {employees} employees x {years} years x {requests_per_year} requests "
+                   f"in {time.perf_counter() - started:.1f}s")
+
+        scenarios = build_scenarios(base_url, admin_token, logins, datetime.now().year)
+        results = {
+            "config": {
+                "backend": "in-memory" if in_memory else "mongodb",
+                "employees": employees, "years": years, "requests_per_year": requests_per_year,
+                "requests": requests_per_scenario, "concurrency": concurrency,
+            },
+            "scenarios": {},
+        }
+        typer.echo(f"{'scenario':<24}{'requests':>9}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>9}")
+        for name, (call, share) in scenarios.items():
+            if scenario and name not in scenario:
+                continue
+            summary = run_scenario(call, max(1, int(requests_per_scenario * share)), concurrency, warmup)
+            results["scenarios"][name] = summary
+            typer.echo(f"{name:<24}{summary['requests']:>9}{summary['errors']:>8}{summary['p50_ms']:>10}"
+                       f"{summary['p95_ms']:>10}{summary['p99_ms']:>10}{summary['throughput_rps']:>9}")
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        if not in_memory and not keep_data:
+            from pymongo import MongoClient
+            MongoClient(mongo_url, serverSelectionTimeoutMS=2000).drop_database(db_name)
+
+    for path in (output, save_baseline):
+        if path:
+            path.write_text(json.dumps(results, indent=2) + "\n")
+
+    failures = [f"{name}: {summary['errors']} errors" for name, summary in results["scenarios"].items() if summary["errors"]]
+    if baseline:
+        stored = json.loads(baseline.read_text())
+        if stored.get("config") != results["config"]:
+            typer.echo("Warning: baseline recorded with a different configuration", err=True)
+        failures += compare_with_baseline(results, stored, tolerance)
+
+    for failure in failures:
+        typer.echo(f"FAIL {failure}", err=True)
+    if failures:
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,26 @@
+"""
+Run server:app on an in-memory MongoDB stand-in (mongomock-motor).
+
+Used by load_test.py --in-memory when no MongoDB is available. Numbers
+measured this way exercise the API code, not MongoDB, and are only
+comparable with baselines recorded the same way.
+
+    python benchmarks/memory_server.py PORT
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import uvicorn
+from mongomock_motor import AsyncMongoMockClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+server.client = AsyncMongoMockClient()
+server.db = server.client[os.environ["DB_NAME"]]
+
+if __name__ == "__main__":
+    uvicorn.run(server.app, host="127.0.0.1", port=int(sys.argv[1]), log_level="warning")
@@ -0,0 +1,152 @@
+"""
+Benchmark of the yearly vacation rollover on synthetic employees.
+
+Seeds a throwaway database with active employees, their previous-year
+allowances and approved ferie in the rollover year, then times:
+- lazy: get_or_create_vacation_allowance for a sample of employees, one
+  after the other, as the first vacation summaries of January would;
+- batch: rollover_vacation_allowances for every employee.
+
+    python benchmarks/rollover_benchmark.py                  # 10000 employees on MONGO_URL
+    python benchmarks/rollover_benchmark.py --in-memory --employees 2000
+"""
+
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+import typer
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+cli = typer.Typer()
+
+SEED_CHUNK_SIZE = 5000
+
+
+def ferie_request(user_id: str, year: int, week: int) -> dict:
+    """An approved Tuesday-Thursday ferie request in the given week of the year"""
+    import server
+
+    tuesday = date(year, 1, 1) + timedelta(days=(1 - date(year, 1, 1).weekday()) % 7, weeks=week)
+    request_doc = {
+        "id": str(uuid.uuid4()), "user_id": user_id, "type": "ferie", "status": "approved",
+        "start_date": tuesday.isoformat(), "end_date": (tuesday + timedelta(days=2)).isoformat(),
+        "created_at": datetime.utcnow()
+    }
+    request_doc.update(server.derived_request_fields(request_doc))
+    return request_doc
+
+
+async def seed(employees: int, year: int, requests_per_employee: int) -> list:
+    import server
+
+    employee_ids = []
+    for offset in range(0, employees, SEED_CHUNK_SIZE):
+        users, allowances, requests = [], [], []
+        for i in range(offset, min(employees, offset + SEED_CHUNK_SIZE)):
+            user = server.User(username=f"bench{i:05d}", email=f"bench{i:05d}@benchmark-company.com", password_hash="x")
+            employee_ids.append(user.id)
+            users.append(user.dict())
+            allowances.append({
+                "id": str(uuid.uuid4()), "user_id": user.id, "year": year - 1, "max_days": 20,
+                "used_days": 20 - i % 10, "carried_over_days": 0, "remaining_days": i % 10, "version": 0
+            })
+            requests.extend(ferie_request(user.id, year, week) for week in range(requests_per_employee))
+        await server.db.users.insert_many(users)
+        await server.db.vacation_allowances.insert_many(allowances)
+        if requests:
+            await server.db.requests.insert_many(requests)
+    return employee_ids
+
+
+async def run(employees: int, requests_per_employee: int, lazy_sample: int, batch_size: int, in_memory: bool) -> dict:
+    import server
+
+    if in_memory:
+        from mongomock_motor import AsyncMongoMockClient
+        server.client = AsyncMongoMockClient()
+        server.db = server.client[os.environ["DB_NAME"]]
+    else:
+        await server.ensure_indexes()
+
+    year = datetime.utcnow().year + 1
+    started = time.perf_counter()
+    employee_ids = await seed(employees, year, requests_per_employee)
+    seed_seconds = time.perf_counter() - started
+
+    sample = employee_ids[:lazy_sample]
+    started = time.perf_counter()
+    for user_id in sample:
+        await server.get_or_create_vacation_allowance(user_id, year)
+    lazy_seconds = time.perf_counter() - started
+    # The batch job has to create every allowance itself
+    await server.db.vacation_allowances.delete_many({"year": year})
+
+    started = time.perf_counter()
+    result = await server.rollover_vacation_allowances(year, batch_size=batch_size)
+    batch_seconds = time.perf_counter() - started
+
+    lazy_per_employee = lazy_seconds / len(sample) if sample else None
+    return {
+        "config": {
+            "backend": "in-memory" if in_memory else "mongodb", "employees": employees,
+            "requests_per_employee": requests_per_employee, "batch_size": batch_size,
+        },
+        "seed_seconds": round(seed_seconds, 2),
+        "batch": {
+            "created": result["created"],
+            "seconds": round(batch_seconds, 3),
+            "employees_per_second": round(employees / batch_seconds, 1),
+        },
+        "lazy": {
+            "sample": len(sample),
+            "ms_per_employee": round(lazy_per_employee * 1000, 3) if sample else None,
+            "estimated_seconds_for_all": round(lazy_per_employee * employees, 2) if sample else None,
+        },
+    }
+
+
+@cli.command()
+def main(
+    mongo_url: str = typer.Option(os.environ.get("MONGO_URL", "mongodb://localhost:27017"), help="MongoDB da usare"),
+    in_memory: bool = typer.Option(False, "--in-memory", help="Usa mongomock-motor al posto di MongoDB"),
+    employees: int = typer.Option(10000, min=1, help="Dipendenti da creare"),
+    requests_per_employee: int = typer.Option(3, min=0, max=50, help="Ferie approvate per dipendente nell'anno"),
+    lazy_sample: int = typer.Option(500, min=0, help="Dipendenti su cui misurare la creazione lazy"),
+    batch_size: int = typer.Option(1000, min=1, help="Dipendenti per bulk write"),
+    output: Optional[Path] = typer.Option(None, help="Scrivi i risultati in JSON"),
+    keep_data: bool = typer.Option(False, "--keep-data", help="Non cancellare il database di benchmark"),
+):
+    """Time the batch rollover against lazy allowance creation"""
+    db_name = f"leave_benchmark_{uuid.uuid4().hex[:8]}"
+    os.environ["MONGO_URL"] = mongo_url
+    os.environ["DB_NAME"] = db_name
+    import server
+
+    try:
+        results = asyncio.run(run(employees, requests_per_employee, lazy_sample, batch_size, in_memory))
+    finally:
+        if not in_memory and not keep_data:
+            from pymongo import MongoClient
+            MongoClient(mongo_url, serverSelectionTimeoutMS=2000).drop_database(db_name)
+        server.password_executor.shutdown(wait=False)
+
+    typer.echo(f"Seeded {employees} employees in {results['seed_seconds']}s")
+    batch, lazy = results["batch"], results["lazy"]
+    typer.echo(f"batch: {batch['created']} allowances in {batch['seconds']}s ({batch['employees_per_second']} employees/s)")
+    if lazy["sample"]:
+        typer.echo(f"lazy:  {lazy['ms_per_employee']} ms per employee over {lazy['sample']}, "
+                   f"~{lazy['estimated_seconds_for_all']}s for all {employees}")
+    if output:
+        output.write_text(json.dumps(results, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    cli()
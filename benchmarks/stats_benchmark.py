@@ -0,0 +1,158 @@
+"""
+Benchmark of the leave stats aggregation against the Python loop it replaced.
+
+Seeds a throwaway database with employees and several years of approved,
+pending and rejected requests, then computes the yearly stats of a sample
+of employees twice:
+- aggregation: compute_leave_stats, which only returns the totals;
+- python: every approved request of the year fetched and summed in Python,
+  as the stats endpoints did before.
+
+Both must give the same totals; the timings are reported per call.
+
+    python benchmarks/stats_benchmark.py                  # 200 employees × 5 years on MONGO_URL
+    python benchmarks/stats_benchmark.py --in-memory --employees 50
+"""
+
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+import typer
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+cli = typer.Typer()
+
+STATUSES = ("approved", "approved", "approved", "pending", "rejected")
+STATS_KEYS = ("ferie_days", "permessi_count", "malattie_days", "total_requests")
+
+
+def employee_requests(user_id: str, years: range, requests_per_year: int) -> list:
+    """Requests of every type spread over each year, some crossing into the next one"""
+    import server
+
+    docs = []
+    for year in years:
+        first_monday = date(year, 1, 1) + timedelta(days=(7 - date(year, 1, 1).weekday()) % 7)
+        for i in range(requests_per_year):
+            monday = first_monday + timedelta(weeks=i * 52 // requests_per_year)
+            request_doc = {"id": str(uuid.uuid4()), "user_id": user_id,
+                           "status": STATUSES[i % len(STATUSES)], "created_at": datetime(year, 1, 1)}
+            if i % 3 == 0:
+                request_doc.update(type="ferie", start_date=monday.isoformat(),
+                                   end_date=(monday + timedelta(days=4 + i % 10)).isoformat())
+            elif i % 3 == 1:
+                request_doc.update(type="permesso", permit_date=monday.isoformat(),
+                                   start_time="09:00", end_time="11:00")
+            else:
+                request_doc.update(type="malattia", sick_start_date=monday.isoformat(), sick_days=1 + i % 5)
+            request_doc.update(server.derived_request_fields(request_doc))
+            docs.append(request_doc)
+    return docs
+
+
+async def python_stats(user_id: str, year: int) -> dict:
+    """The per-request loop: fetch the approved requests of the year and sum their shares"""
+    import server
+
+    requests = await server.db.requests.find(
+        {"user_id": user_id, "status": "approved", "days_by_year.year": year}, {"_id": 0}
+    ).to_list(None)
+    totals = dict.fromkeys(STATS_KEYS, 0)
+    for request_doc in requests:
+        for share in server.leave_days_by_year(request_doc):
+            if share["year"] == year:
+                for key in STATS_KEYS:
+                    totals[key] += share[key]
+    return totals
+
+
+async def time_calls(calls: list, compute) -> tuple:
+    results = []
+    started = time.perf_counter()
+    for user_id, year in calls:
+        results.append(await compute(user_id, year))
+    return results, time.perf_counter() - started
+
+
+async def run(employees: int, years: int, requests_per_year: int, sample: int, in_memory: bool) -> dict:
+    import server
+
+    if in_memory:
+        from mongomock_motor import AsyncMongoMockClient
+        server.client = AsyncMongoMockClient()
+        server.db = server.client[os.environ["DB_NAME"]]
+    else:
+        await server.ensure_indexes()
+
+    last_year = datetime.utcnow().year
+    year_range = range(last_year - years + 1, last_year + 1)
+    employee_ids = [str(uuid.uuid4()) for _ in range(employees)]
+    started = time.perf_counter()
+    for user_id in employee_ids:
+        await server.db.requests.insert_many(employee_requests(user_id, year_range, requests_per_year))
+    seed_seconds = time.perf_counter() - started
+
+    calls = [(user_id, year) for user_id in employee_ids[:sample] for year in year_range]
+    aggregated, aggregation_seconds = await time_calls(calls, server.compute_leave_stats)
+    looped, python_seconds = await time_calls(calls, python_stats)
+    mismatches = [call for call, a, b in zip(calls, aggregated, looped) if a != b]
+
+    return {
+        "config": {
+            "backend": "in-memory" if in_memory else "mongodb", "employees": employees, "years": years,
+            "requests_per_year": requests_per_year, "calls": len(calls),
+        },
+        "seed_seconds": round(seed_seconds, 2),
+        "aggregation_ms_per_call": round(aggregation_seconds / len(calls) * 1000, 3),
+        "python_ms_per_call": round(python_seconds / len(calls) * 1000, 3),
+        "speedup": round(python_seconds / aggregation_seconds, 2),
+        "mismatches": len(mismatches),
+    }
+
+
+@cli.command()
+def main(
+    mongo_url: str = typer.Option(os.environ.get("MONGO_URL", "mongodb://localhost:27017"), help="MongoDB da usare"),
+    in_memory: bool = typer.Option(False, "--in-memory", help="Usa mongomock-motor al posto di MongoDB"),
+    employees: int = typer.Option(200, min=1, help="Dipendenti da creare"),
+    years: int = typer.Option(5, min=1, max=20, help="Anni di storico per dipendente"),
+    requests_per_year: int = typer.Option(40, min=1, max=52, help="Richieste per dipendente e anno"),
+    sample: int = typer.Option(50, min=1, help="Dipendenti di cui calcolare le statistiche di ogni anno"),
+    output: Optional[Path] = typer.Option(None, help="Scrivi i risultati in JSON"),
+    keep_data: bool = typer.Option(False, "--keep-data", help="Non cancellare il database di benchmark"),
+):
+    """Time compute_leave_stats against the per-request Python loop"""
+    db_name = f"leave_benchmark_{uuid.uuid4().hex[:8]}"
+    os.environ["MONGO_URL"] = mongo_url
+    os.environ["DB_NAME"] = db_name
+    import server
+
+    try:
+        results = asyncio.run(run(employees, years, requests_per_year, min(sample, employees), in_memory))
+    finally:
+        if not in_memory and not keep_data:
+            from pymongo import MongoClient
+            MongoClient(mongo_url, serverSelectionTimeoutMS=2000).drop_database(db_name)
+        server.password_executor.shutdown(wait=False)
+
+    typer.echo(f"Seeded {employees} employees × {years} years in {results['seed_seconds']}s")
+    typer.echo(f"aggregation: {results['aggregation_ms_per_call']} ms per call over {results['config']['calls']}")
+    typer.echo(f"python:      {results['python_ms_per_call']} ms per call (python / aggregation = {results['speedup']}×)")
+    if results["mismatches"]:
+        typer.echo(f"{results['mismatches']} (employee, year) pairs differ between the two", err=True)
+    if output:
+        output.write_text(json.dumps(results, indent=2) + "\n")
+    if results["mismatches"]:
+        raise typer.Exit(1)
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from "react";
+import React, { useState, useEffect, useRef } from "react";
 import "./App.css";
 import axios from "axios";
 import { Calendar, Users, Clock, Activity, Settings, LogOut, Plus, Mail, CheckCircle, XCircle, Bell, Edit, Trash2, ArrowLeft, BarChart3, TrendingUp, User, Calculator, Save, AlertCircle } from "lucide-react";
@@ -9,6 +9,81 @@ const API = `${BACKEND_URL}/api`;
 // Configure axios defaults
 axios.defaults.headers.common['Authorization'] = localStorage.getItem('token') ? `Bearer ${localStorage.getItem('token')}` : null;
 
+// Live request events from the backend (Server-Sent Events); handlers are keyed by event name.
+// 'ready' arrives on every (re)connection: events missed while disconnected are lost, so reload there
+const REQUEST_EVENTS = ['ready', 'request_created', 'request_updated', 'request_deleted', 'request_status', 'dashboard'];
+const EVENTS_RECONNECT_MS = 3000;
+// A bulk approval emits one event per request: reloads are coalesced into one per window
+const EVENTS_RELOAD_DELAY_MS = 500;
+
+const useRequestEvents = (handlers) => {
+  const handlersRef = useRef(handlers);
+  handlersRef.current = handlers;
+
+  useEffect(() => {
+    if (!localStorage.getItem('token')) return undefined;
+
+    let source = null;
+    let reconnectTimer = null;
+    let closed = false;
+
+    const scheduleReconnect = () => {
+      if (!closed) reconnectTimer = setTimeout(connect, EVENTS_RECONNECT_MS);
+    };
+
+    // The stream token expires within a minute, so every connection asks for a fresh one
+    // instead of letting EventSource retry with the old URL
+    const connect = async () => {
+      let token;
+      try {
+        const response = await axios.post(`${API}/events/token`);
+        token = response.data.token;
+      } catch (error) {
+        scheduleReconnect();
+        return;
+      }
+      if (closed) return;
+
+      const stream = new EventSource(`${API}/events?token=${encodeURIComponent(token)}`);
+      source = stream;
+      REQUEST_EVENTS.forEach((name) => {
+        stream.addEventListener(name, (event) => {
+          const handler = handlersRef.current[name];
+          if (handler) handler(JSON.parse(event.data));
+        });
+      });
+      stream.onerror = () => {
+        stream.close();
+        scheduleReconnect();
+      };
+    };
+
+    connect();
+    return () => {
+      closed = true;
+      clearTimeout(reconnectTimer);
+      if (source) source.close();
+    };
+  }, []);
+};
+
+// Returns a function that runs reload once, EVENTS_RELOAD_DELAY_MS after the first of a burst of calls
+const useCoalescedReload = (reload) => {
+  const reloadRef = useRef(reload);
+  reloadRef.current = reload;
+  const timerRef = useRef(null);
+
+  useEffect(() => () => clearTimeout(timerRef.current), []);
+
+  return () => {
+    if (timerRef.current) return;
+    timerRef.current = setTimeout(() => {
+      timerRef.current = null;
+      reloadRef.current();
+    }, EVENTS_RELOAD_DELAY_MS);
+  };
+};
+
 function App() {
   const [user, setUser] = useState(null);
   const [loading, setLoading] = useState(false);
@@ -176,6 +251,16 @@ const EmployeeDashboard = ({ currentPage, setCurrentPage, user }) => {
     loadRequests();
   }, []);
 
+  const scheduleReload = useCoalescedReload(() => loadRequests());
+
+  useRequestEvents({
+    ready: scheduleReload,
+    request_created: scheduleReload,
+    request_updated: scheduleReload,
+    request_deleted: scheduleReload,
+    request_status: scheduleReload
+  });
+
   const loadRequests = async () => {
     try {
       const response = await axios.get(`${API}/requests`);
@@ -732,7 +817,7 @@ const EditRequestForm = ({ request, onSuccess, onCancel }) => {
       case 'ferie':
         return (
           <div className="space-y-4">
-            <h3 className="text-lg font-semibold text-slate-800">Modifica Richiesta Ferie (max 15 giorni consecutivi)</h3>
+            <h3 className="text-lg font-semibold text-slate-800">Modifica Richiesta Ferie (max 15 giorni lavorativi)</h3>
             <div className="grid grid-cols-1 md:grid-cols-2 gap-4">
               <div>
                 <label className="block text-sm font-medium text-slate-700 mb-2">Data inizio</label>
@@ -912,7 +997,7 @@ const NewRequestForm = ({ onSuccess }) => {
       case 'ferie':
         return (
           <div className="space-y-4">
-            <h3 className="text-lg font-semibold text-slate-800">Richiesta Ferie (max 15 giorni consecutivi)</h3>
+            <h3 className="text-lg font-semibold text-slate-800">Richiesta Ferie (max 15 giorni lavorativi)</h3>
             <div className="grid grid-cols-1 md:grid-cols-2 gap-4">
               <div>
                 <label className="block text-sm font-medium text-slate-700 mb-2">Data inizio</label>
@@ -1107,6 +1192,45 @@ const AdminDashboard = ({ currentPage, setCurrentPage }) => {
     loadDashboardData();
   }, []);
 
+  const reloadStats = async () => {
+    try {
+      const response = await axios.get(`${API}/admin/dashboard`);
+      setStats(response.data);
+    } catch (error) {
+      console.error('Errore nel caricamento delle statistiche:', error);
+    }
+  };
+
+  const reloadRequests = async () => {
+    try {
+      const response = await axios.get(`${API}/requests`);
+      setRequests(response.data);
+    } catch (error) {
+      console.error('Errore nel caricamento delle richieste:', error);
+    }
+  };
+
+  const scheduleReloadRequests = useCoalescedReload(() => reloadRequests());
+
+  useRequestEvents({
+    // The deltas applied so far may be incomplete after a reconnection
+    ready: () => {
+      reloadStats();
+      scheduleReloadRequests();
+    },
+    dashboard: (delta) => setStats((current) => {
+      const updated = { ...current };
+      Object.entries(delta).forEach(([key, value]) => {
+        updated[key] = (updated[key] || 0) + value;
+      });
+      return updated;
+    }),
+    request_created: scheduleReloadRequests,
+    request_updated: scheduleReloadRequests,
+    request_deleted: scheduleReloadRequests,
+    request_status: scheduleReloadRequests
+  });
+
   const loadDashboardData = async () => {
     try {
       const [statsResponse, requestsResponse, employeesResponse] = await Promise.all([
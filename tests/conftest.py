@@ -0,0 +1,58 @@
+"""
+Shared fixtures for the MongoDB-backed tests.
+
+Tests run against throwaway databases on the MongoDB configured by
+backend/.env (MONGO_URL) and are skipped when it is not reachable.
+"""
+
+import asyncio
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient
+from pymongo.errors import ServerSelectionTimeoutError
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def mongo_client():
+    client = MongoClient(server.mongo_url, serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command("ping")
+    except ServerSelectionTimeoutError:
+        pytest.skip("MongoDB not reachable")
+    yield client
+    client.close()
+
+
+@pytest.fixture(scope="module")
+def test_db_name(mongo_client):
+    name = f"leave_management_test_{uuid.uuid4().hex[:8]}"
+    yield name
+    mongo_client.drop_database(name)
+
+
+@pytest.fixture
+def server_db(mongo_client):
+    """Point server.db at a fresh indexed database for one test, dropped afterwards"""
+    name = f"leave_management_test_{uuid.uuid4().hex[:8]}"
+    original_db = server.db
+    motor_client = AsyncIOMotorClient(server.mongo_url)
+    try:
+        server.db = motor_client[name]
+        asyncio.run(server.ensure_indexes())
+        # A Motor client sticks to the event loop of its first operation: the test gets a new one
+        motor_client.close()
+        motor_client = AsyncIOMotorClient(server.mongo_url)
+        server.db = motor_client[name]
+        yield server.db
+    finally:
+        server.db = original_db
+        motor_client.close()
+        mongo_client.drop_database(name)
@@ -0,0 +1,50 @@
+"""
+Checks for the streamed CSV exports: values typed by employees must not
+reach the spreadsheet as formulas.
+"""
+
+import asyncio
+import csv
+import io
+
+import server
+
+
+class ListCursor:
+    """The part of a Motor cursor used by stream_csv, over a list of documents"""
+    def __init__(self, docs):
+        self.docs = docs
+
+    def batch_size(self, size):
+        return self
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self.docs:
+            yield doc
+
+
+def export(docs, columns, batch_size=2):
+    async def collect():
+        return "".join([chunk async for chunk in server.stream_csv(ListCursor(docs), columns, batch_size=batch_size)])
+    return list(csv.DictReader(io.StringIO(asyncio.run(collect()).lstrip("\ufeff"))))
+
+
+def test_formula_cells_are_quoted():
+    docs = [
+        {"username": "=HYPERLINK(\"http://evil\",\"x\")", "protocol_code": "+1+1", "notes": "@SUM(A1)"},
+        {"username": "-2+3", "protocol_code": "\tcmd", "notes": "ok"},
+        {"username": "mario.rossi", "protocol_code": "ABC-123", "notes": None},
+    ]
+    rows = export(docs, ["username", "protocol_code", "notes"])
+
+    assert rows[0] == {"username": "'=HYPERLINK(\"http://evil\",\"x\")", "protocol_code": "'+1+1", "notes": "'@SUM(A1)"}
+    assert rows[1] == {"username": "'-2+3", "protocol_code": "'\tcmd", "notes": "ok"}
+    assert rows[2] == {"username": "mario.rossi", "protocol_code": "ABC-123", "notes": ""}
+
+
+def test_numbers_are_not_quoted():
+    rows = export([{"year": 2025, "remaining_days": -3}], ["year", "remaining_days"])
+    assert rows == [{"year": "2025", "remaining_days": "-3"}]
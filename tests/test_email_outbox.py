@@ -0,0 +1,162 @@
+"""
+Checks for the durable email outbox: claiming due messages, retries with
+exponential backoff, reclaiming expired leases, lease renewal during a
+batch and redaction of delivered bodies. The SMTP side is replaced by a
+recording mailer.
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+
+class RecordingMailer:
+    """Records the recipients it is asked to deliver to, failing while fail is set"""
+    def __init__(self, fail: bool = False, on_send=None):
+        self.fail = fail
+        self.on_send = on_send
+        self.sent = []
+
+    async def send(self, msg):
+        if self.on_send:
+            await self.on_send(len(self.sent))
+        self.sent.append(msg["To"])
+        if self.fail:
+            raise ConnectionError("SMTP server unreachable")
+
+
+@pytest.fixture
+def restore_mailer():
+    original = server.mailer
+    yield original
+    server.mailer = original
+
+
+async def queue(*recipients: str):
+    await server.enqueue_emails([
+        {"to_email": to_email, "subject": "Test", "body": "password: secret", "html_body": "<p>secret</p>"}
+        for to_email in recipients
+    ])
+
+
+async def outbox() -> dict:
+    return {doc["to_email"]: doc async for doc in server.db.email_outbox.find({}, {"_id": 0})}
+
+
+async def run_claim() -> dict:
+    await queue("a@company.com", "b@company.com", "later@company.com")
+    await server.db.email_outbox.update_one(
+        {"to_email": "later@company.com"}, {"$set": {"next_attempt_at": datetime.utcnow() + timedelta(minutes=5)}}
+    )
+    first = await server.claim_outbox_batch()
+    second = await server.claim_outbox_batch()
+    return {"first": first, "second": second}
+
+
+def test_claim_takes_due_messages_once(server_db):
+    result = asyncio.run(run_claim())
+
+    assert sorted(doc["to_email"] for doc in result["first"]) == ["a@company.com", "b@company.com"]
+    assert {doc["status"] for doc in result["first"]} == {"sending"}
+    assert len({doc["claim_id"] for doc in result["first"]}) == 1
+    assert result["second"] == []
+
+
+async def run_expired_lease() -> dict:
+    await queue("stale@company.com", "fresh@company.com")
+    first = await server.claim_outbox_batch()
+    # The dispatcher holding stale@ crashed a while ago
+    await server.db.email_outbox.update_one(
+        {"to_email": "stale@company.com"},
+        {"$set": {"claimed_at": datetime.utcnow() - timedelta(seconds=server.EMAIL_OUTBOX_LEASE_SECONDS + 1)}}
+    )
+    second = await server.claim_outbox_batch()
+    return {"first": first, "second": second}
+
+
+def test_expired_lease_is_claimed_again(server_db):
+    result = asyncio.run(run_expired_lease())
+
+    assert [doc["to_email"] for doc in result["second"]] == ["stale@company.com"]
+    assert result["second"][0]["claim_id"] != result["first"][0]["claim_id"]
+
+
+async def run_failures(attempts_before: int) -> dict:
+    server.mailer = RecordingMailer(fail=True)
+    await queue("a@company.com")
+    await server.db.email_outbox.update_one({}, {"$set": {"attempts": attempts_before}})
+    started = datetime.utcnow()
+    await server.dispatch_outbox_batch()
+    return {"started": started, "email": (await outbox())["a@company.com"]}
+
+
+def test_failed_send_is_retried_with_backoff(server_db, restore_mailer):
+    result = asyncio.run(run_failures(attempts_before=2))
+    email = result["email"]
+
+    assert email["status"] == "pending"
+    assert email["attempts"] == 3
+    assert email["last_error"] == "SMTP server unreachable"
+    delay = (email["next_attempt_at"] - result["started"]).total_seconds()
+    expected = server.EMAIL_OUTBOX_RETRY_BASE_SECONDS * 4
+    # MongoDB keeps milliseconds only
+    assert expected - 0.001 <= delay < expected + 5
+    assert email["body"] == "password: secret"
+
+
+def test_last_failed_attempt_gives_up_and_redacts(server_db, restore_mailer):
+    result = asyncio.run(run_failures(attempts_before=server.EMAIL_OUTBOX_MAX_ATTEMPTS - 1))
+    email = result["email"]
+
+    assert email["status"] == "failed"
+    assert email["attempts"] == server.EMAIL_OUTBOX_MAX_ATTEMPTS
+    assert email["body"] is None
+    assert email["html_body"] is None
+
+
+async def run_delivery() -> dict:
+    server.mailer = RecordingMailer()
+    await queue("a@company.com", "b@company.com")
+    dispatched = await server.dispatch_outbox_batch()
+    return {"dispatched": dispatched, "sent": server.mailer.sent, "outbox": await outbox()}
+
+
+def test_delivered_messages_are_redacted(server_db, restore_mailer):
+    result = asyncio.run(run_delivery())
+
+    assert result["dispatched"] == 2
+    assert sorted(result["sent"]) == ["a@company.com", "b@company.com"]
+    for email in result["outbox"].values():
+        assert email["status"] == "sent"
+        assert email["attempts"] == 1
+        assert email["body"] is None
+        assert email["html_body"] is None
+
+
+async def run_slow_batch() -> dict:
+    """Every send takes longer than the lease; another dispatcher polls before each of them"""
+    competing_claims = []
+
+    async def slow_send(already_sent: int):
+        if already_sent:
+            competing_claims.extend(await server.claim_outbox_batch())
+        await server.db.email_outbox.update_many(
+            {"status": "sending"},
+            {"$set": {"claimed_at": datetime.utcnow() - timedelta(seconds=server.EMAIL_OUTBOX_LEASE_SECONDS + 1)}}
+        )
+
+    server.mailer = RecordingMailer(on_send=slow_send)
+    await queue("a@company.com", "b@company.com", "c@company.com")
+    await server.dispatch_outbox_batch()
+    return {"sent": server.mailer.sent, "competing_claims": competing_claims, "outbox": await outbox()}
+
+
+def test_lease_is_renewed_during_a_slow_batch(server_db, restore_mailer):
+    result = asyncio.run(run_slow_batch())
+
+    assert result["competing_claims"] == []
+    assert sorted(result["sent"]) == ["a@company.com", "b@company.com", "c@company.com"]
+    assert {email["status"] for email in result["outbox"].values()} == {"sent"}
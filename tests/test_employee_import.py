@@ -0,0 +1,134 @@
+"""
+Checks for the employee CSV import: parsing and row validation run
+without MongoDB, the duplicate checks against existing users need it.
+"""
+
+import asyncio
+
+import pytest
+
+import server
+
+
+def test_read_employee_csv_accepts_semicolons_and_bom():
+    rows = server.read_employee_csv("\ufeffUsername;Email\nmario.rossi;mario@company.com\n".encode("utf-8"))
+    assert rows == [(2, {"Username": "mario.rossi", "Email": "mario@company.com"})]
+
+
+def test_read_employee_csv_numbers_rows_by_file_line():
+    rows = server.read_employee_csv(
+        b"username,email\n"
+        b"\n"
+        b"mario.rossi,mario@company.com\n"
+        b"\"luigi\nverdi\",luigi\n"
+        b"ab,ab@company.com\n"
+    )
+    assert [line for line, _ in rows] == [3, 5, 6]
+
+    candidates, errors = server.parse_employee_rows(rows)
+    assert [line for line, _ in candidates] == [3]
+    assert [error["line"] for error in errors] == [5, 6]
+
+
+def test_user_create_lowercases_email():
+    assert server.UserCreate(username="mario.rossi", email="Mario.Rossi@Company.com", password="secret1").email == \
+        "mario.rossi@company.com"
+
+
+def test_read_employee_csv_rejects_missing_columns():
+    with pytest.raises(ValueError):
+        server.read_employee_csv(b"username,password\nmario.rossi,secret1\n")
+
+
+def test_read_employee_csv_rejects_non_utf8():
+    with pytest.raises(ValueError):
+        server.read_employee_csv("username,email\nnicolò,n@company.com\n".encode("latin-1"))
+
+
+def test_parse_rows_ignores_trailing_comma():
+    rows = server.read_employee_csv(b"username,email\nmario.rossi,mario@company.com,\n")
+    candidates, errors = server.parse_employee_rows(rows)
+    assert errors == []
+    assert [data.username for _, data in candidates] == ["mario.rossi"]
+
+
+def test_parse_rows_reports_extra_fields():
+    rows = server.read_employee_csv(b"username,email\nmario.rossi,mario@company.com,secret1\n")
+    candidates, errors = server.parse_employee_rows(rows)
+    assert candidates == []
+    assert errors == [{"line": 2, "username": "mario.rossi", "error": "Più colonne dell'intestazione"}]
+
+
+def test_parse_rows_validates_and_deduplicates_case_insensitively():
+    rows = server.read_employee_csv(
+        b"username,email,password\n"
+        b"mario.rossi,Mario@Company.com,secret1\n"
+        b",,\n"
+        b"ab,ab@company.com,secret1\n"
+        b"mario.bianchi,mario@company.com,secret1\n"
+        b"luigi.verdi,luigi@company.com,\n"
+    )
+    candidates, errors = server.parse_employee_rows(rows)
+
+    assert [(line, data.email) for line, data in candidates] == [(2, "mario@company.com"), (6, "luigi@company.com")]
+    # A generated password when the column is empty
+    assert len(candidates[1][1].password) >= 6
+    assert [(error["line"], error["username"]) for error in errors] == [(4, "ab"), (5, "mario.bianchi")]
+
+
+async def run_import() -> dict:
+    existing = server.User(username="mario.rossi", email="Mario.Rossi@company.com", password_hash="x")
+    await server.db.users.insert_one(existing.dict())
+
+    rows = server.read_employee_csv(
+        b"username,email\n"
+        b"mario.rossi2,mario.rossi@COMPANY.com\n"
+        b"mario.rossi,other@company.com\n"
+        b"luigi.verdi,Luigi.Verdi@company.com,\n"
+    )
+    report = await server.import_employees(rows)
+    report["stored_emails"] = await server.db.users.distinct("email", {"id": {"$in": report["employee_ids"]}})
+    report["queued"] = await server.db.email_outbox.count_documents({})
+    return report
+
+
+def test_import_skips_existing_usernames_and_emails(server_db):
+    report = asyncio.run(run_import())
+
+    assert report["created"] == 1
+    assert report["stored_emails"] == ["luigi.verdi@company.com"]
+    assert report["queued"] == 1
+    assert [(error["line"], error["error"]) for error in report["errors"]] == [
+        (2, "Username o email già esistente"),
+        (3, "Username o email già esistente"),
+    ]
+
+
+async def run_create_employee() -> dict:
+    admin = server.User(username="admin", email="admin@company.com", password_hash="x", role="admin")
+    existing = server.User(username="mario.rossi", email="mario.rossi@company.com", password_hash="x")
+    await server.db.users.insert_many([admin.dict(), existing.dict()])
+
+    try:
+        await server.create_employee(
+            server.UserCreate(username="mario.rossi2", email="Mario.Rossi@Company.com", password="secret1"),
+            current_user=admin
+        )
+        duplicate_status = 200
+    except server.HTTPException as e:
+        duplicate_status = e.status_code
+    created = await server.create_employee(
+        server.UserCreate(username="luigi.verdi", email="Luigi.Verdi@Company.com", password="secret1"),
+        current_user=admin
+    )
+    return {
+        "duplicate_status": duplicate_status,
+        "stored_email": (await server.db.users.find_one({"id": created["employee_id"]}))["email"],
+    }
+
+
+def test_create_employee_matches_and_stores_emails_lowercased(server_db):
+    result = asyncio.run(run_create_employee())
+
+    assert result["duplicate_status"] == 400
+    assert result["stored_email"] == "luigi.verdi@company.com"
@@ -0,0 +1,44 @@
+"""
+Checks for the stream-only tokens of GET /api/events: they open the event
+stream, are refused as bearer tokens and expire after a minute.
+"""
+
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def employee():
+    user = server.User(username="mario.rossi", email="mario@company.com", password_hash="x")
+    # Cached, so resolving the token needs no database
+    server.user_cache.set(user)
+    yield user
+    server.user_cache.invalidate(user.id)
+
+
+def test_stream_token_opens_the_event_stream_only(employee):
+    token = asyncio.run(server.create_event_stream_token(current_user=employee))["token"]
+
+    assert asyncio.run(server.get_event_stream_user(token)).id == employee.id
+    with pytest.raises(server.HTTPException) as error:
+        asyncio.run(server.user_from_token(token))
+    assert error.value.status_code == 401
+
+
+def test_login_token_is_refused_by_the_event_stream(employee):
+    token = server.create_access_token(data={"sub": employee.id, "role": employee.role})
+
+    assert asyncio.run(server.user_from_token(token)).id == employee.id
+    with pytest.raises(server.HTTPException):
+        asyncio.run(server.get_event_stream_user(token))
+
+
+def test_expired_stream_token_is_refused(employee):
+    token = server.create_access_token(data={"sub": employee.id, "scope": "events"}, expires_delta=timedelta(seconds=-1))
+
+    with pytest.raises(server.HTTPException):
+        asyncio.run(server.get_event_stream_user(token))
@@ -0,0 +1,120 @@
+"""
+Index usage checks for the hot MongoDB queries issued by backend/server.py.
+
+Each query shape is explained against a scratch database provisioned with
+server.MONGO_INDEXES and must not fall back to a COLLSCAN.
+Requires a reachable MongoDB (MONGO_URL); skipped otherwise.
+"""
+
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+# (collection, filter, sort) for every query pattern used by the endpoints
+QUERY_SHAPES = [
+    ("users", {"id": "u1"}, None),
+    ("users", {"username": "mario.rossi", "is_active": True}, None),
+    ("users", {"$or": [{"username": "mario.rossi"}, {"email": "mario@company.com"}]}, None),
+    ("users", {"role": "employee"}, None),
+    ("users", {"id": {"$in": ["u1", "u2"]}}, None),
+    ("requests", {"id": "r1"}, None),
+    ("requests", {"id": "r1", "user_id": "u1"}, None),
+    ("requests", {}, [("created_at", -1), ("id", -1)]),
+    ("requests", {"user_id": "u1"}, [("created_at", -1), ("id", -1)]),
+    ("requests", {"status": "pending"}, None),
+    ("requests", {"user_id": "u1", "status": "approved", "days_by_year.year": 2025}, None),
+    ("requests", {"user_id": "u1", "type": "ferie", "status": "approved", "days_by_year.year": {"$gte": 2025}}, None),
+    ("requests", {"user_id": {"$in": ["u1", "u2"]}, "type": "ferie", "status": "approved",
+                  "days_by_year.year": 2025}, None),
+    ("requests", {"$or": [
+        {"absence_start": {"$gte": datetime(2025, 7, 2), "$lte": datetime(2025, 8, 31)},
+         "absence_end": {"$gte": datetime(2025, 8, 1)}},
+        {"sick_days": {"$gt": server.CALENDAR_SHORT_ABSENCE_DAYS}, "absence_end": {"$gte": datetime(2025, 8, 1)},
+         "absence_start": {"$lte": datetime(2025, 8, 31)}},
+    ], "status": "approved"}, [("absence_start", 1)]),
+    ("requests", {"user_id": "u1", "absence_end": {"$gte": datetime(2025, 8, 4)},
+                  "absence_start": {"$lte": datetime(2025, 8, 8)}, "status": {"$in": ["pending", "approved"]}}, None),
+    ("absence_headcount", {"day": {"$gte": datetime(2025, 8, 4), "$lte": datetime(2025, 8, 8)},
+                           "count": {"$gte": 3}}, [("day", 1)]),
+    ("vacation_allowances", {"user_id": "u1", "year": 2025}, None),
+    ("vacation_allowances", {"user_id": "u1"}, [("year", -1)]),
+    ("email_outbox", {"status": "pending", "next_attempt_at": {"$lte": datetime.utcnow()}}, None),
+    ("email_outbox", {"dedup_key": "credentials:u1"}, None),
+    ("email_outbox", {"claim_id": "c1", "status": "sending"}, None),
+]
+
+
+@pytest.fixture(scope="module")
+def test_db(mongo_client, test_db_name):
+    database = mongo_client[test_db_name]
+    for collection_name, indexes in server.MONGO_INDEXES.items():
+        database[collection_name].create_indexes(indexes)
+
+    # A few documents so the planner has real choices to make
+    now = datetime.utcnow()
+    database.users.insert_many([
+        {"id": f"u{i}", "username": f"user{i}", "email": f"user{i}@company.com",
+         "role": "employee", "is_active": True, "created_at": now}
+        for i in range(50)
+    ])
+    database.requests.insert_many([
+        {"id": f"r{i}", "user_id": f"u{i % 50}", "type": ["ferie", "permesso", "malattia"][i % 3],
+         "status": ["pending", "approved", "rejected"][i % 3], "created_at": now - timedelta(days=i)}
+        for i in range(500)
+    ])
+    database.vacation_allowances.insert_many([
+        {"id": str(uuid.uuid4()), "user_id": f"u{i}", "year": 2025, "max_days": 20}
+        for i in range(50)
+    ])
+
+    return database
+
+
+def collect_stages(plan):
+    """Return every stage name found in an explain() plan tree"""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(collect_stages(value))
+    elif isinstance(plan, list):
+        for item in plan:
+            stages.extend(collect_stages(item))
+    return stages
+
+
+@pytest.mark.parametrize("collection_name,query,sort", QUERY_SHAPES)
+def test_query_uses_index(test_db, collection_name, query, sort):
+    cursor = test_db[collection_name].find(query)
+    if sort:
+        cursor = cursor.sort(sort)
+    stages = collect_stages(cursor.explain()["queryPlanner"]["winningPlan"])
+
+    assert "COLLSCAN" not in stages, f"{collection_name} {query} does a collection scan: {stages}"
+    assert "IXSCAN" in stages or "IDHACK" in stages or "EXPRESS_IXSCAN" in stages
+
+
+def test_case_insensitive_email_lookup_uses_index(test_db):
+    cursor = test_db.users.find({"email": {"$in": ["User1@Company.com"]}}, collation=server.EMAIL_COLLATION)
+    stages = collect_stages(cursor.explain()["queryPlanner"]["winningPlan"])
+
+    assert "COLLSCAN" not in stages
+    assert test_db.users.count_documents({"email": "USER1@company.com"}, collation=server.EMAIL_COLLATION) == 1
+
+
+async def run_ensure_indexes_after_upgrade() -> dict:
+    await server.db.requests.create_index([("absence_end", 1), ("absence_start", 1)])
+    await server.ensure_indexes()
+    return await server.db.requests.index_information()
+
+
+def test_retired_indexes_are_dropped(server_db):
+    indexes = asyncio.run(run_ensure_indexes_after_upgrade())
+
+    assert "absence_end_1_absence_start_1" not in indexes
+    assert "absence_start_1_absence_end_1" in indexes
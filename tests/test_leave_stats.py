@@ -0,0 +1,85 @@
+"""
+Checks compute_leave_stats, the MongoDB aggregation that rebuilds the
+yearly_stats counters read by the stats endpoints, against a per-request
+Python sum over several years of history.
+Requires a reachable MongoDB (MONGO_URL); skipped otherwise.
+"""
+
+import asyncio
+import uuid
+from datetime import date, datetime, timedelta
+
+import server
+
+YEARS = (2023, 2024, 2025)
+STATS_KEYS = ("ferie_days", "permessi_count", "malattie_days", "total_requests")
+
+
+def history(user_id: str) -> list:
+    """Approved, pending and rejected requests of every type, some crossing a year end"""
+    docs = []
+    for year in YEARS:
+        for week in range(0, 50, 4):
+            monday = date(year, 1, 1) + timedelta(days=(7 - date(year, 1, 1).weekday()) % 7, weeks=week)
+            status = ["approved", "approved", "pending", "rejected"][week // 4 % 4]
+            docs.append({"type": "ferie", "status": status,
+                         "start_date": monday.isoformat(), "end_date": (monday + timedelta(days=4)).isoformat()})
+            docs.append({"type": "permesso", "status": status, "permit_date": (monday + timedelta(days=1)).isoformat(),
+                         "start_time": "09:00", "end_time": "11:00"})
+            docs.append({"type": "malattia", "status": status,
+                         "sick_start_date": (monday + timedelta(days=2)).isoformat(), "sick_days": 2})
+        docs.append({"type": "ferie", "status": "approved",
+                     "start_date": date(year, 12, 28).isoformat(), "end_date": date(year + 1, 1, 8).isoformat()})
+        docs.append({"type": "malattia", "status": "approved",
+                     "sick_start_date": date(year, 12, 30).isoformat(), "sick_days": 5})
+        # Legacy request without dates
+        docs.append({"type": "permesso", "status": "approved", "created_at": datetime(year, 6, 1)})
+
+    for doc in docs:
+        doc.update({"id": str(uuid.uuid4()), "user_id": user_id})
+        doc.setdefault("created_at", datetime.utcnow())
+        doc.update(server.derived_request_fields(doc))
+    return docs
+
+
+def python_totals(docs: list, year: int, request_type: str = None) -> dict:
+    totals = dict.fromkeys(STATS_KEYS, 0)
+    for doc in docs:
+        if doc["status"] != "approved" or (request_type and doc["type"] != request_type):
+            continue
+        for share in server.leave_days_by_year(doc):
+            if share["year"] == year:
+                for key in STATS_KEYS:
+                    totals[key] += share[key]
+    return totals
+
+
+async def run_stats() -> list:
+    docs = history("u1") + history("u2")
+    await server.db.requests.insert_many([dict(doc) for doc in docs])
+    own_docs = [doc for doc in docs if doc["user_id"] == "u1"]
+
+    comparisons = []
+    for year in (YEARS[0] - 1, *YEARS, YEARS[-1] + 1):
+        for request_type in (None, "ferie", "malattia"):
+            comparisons.append((
+                year, request_type,
+                await server.compute_leave_stats("u1", year, request_type),
+                python_totals(own_docs, year, request_type)
+            ))
+    return comparisons
+
+
+def test_aggregation_matches_python_totals(server_db):
+    for year, request_type, aggregated, expected in asyncio.run(run_stats()):
+        assert aggregated == expected, (year, request_type)
+
+
+def test_aggregation_counts_cross_year_shares(server_db):
+    comparisons = {(year, request_type): aggregated
+                   for year, request_type, aggregated, _ in asyncio.run(run_stats())}
+
+    # Only the January share of the ferie from 28 Dec 2025 and the sick days from 30 Dec 2025
+    assert comparisons[(YEARS[-1] + 1, None)]["total_requests"] == 2
+    assert comparisons[(YEARS[-1] + 1, "malattia")]["malattie_days"] == 3
+    assert comparisons[(YEARS[-1] + 1, "ferie")]["ferie_days"] > 0
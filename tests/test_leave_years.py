@@ -0,0 +1,115 @@
+"""
+Checks for the attribution of leave to calendar years: the request date
+ranges, their per-year shares, the sign of a status change and the
+one-off backfill of the shares on requests saved by older versions.
+"""
+
+import asyncio
+import uuid
+from datetime import date, datetime
+
+import pytest
+
+import server
+
+
+def share(year, ferie_days=0, permessi_count=0, malattie_days=0):
+    return {"year": year, "ferie_days": ferie_days, "permessi_count": permessi_count,
+            "malattie_days": malattie_days, "total_requests": 1}
+
+
+@pytest.mark.parametrize("request_doc,expected", [
+    ({"type": "ferie", "start_date": "2025-08-04", "end_date": "2025-08-08"},
+     (datetime(2025, 8, 4), datetime(2025, 8, 8))),
+    # Dates stored as datetimes by older versions
+    ({"type": "ferie", "start_date": datetime(2025, 8, 4, 10), "end_date": date(2025, 8, 8)},
+     (datetime(2025, 8, 4), datetime(2025, 8, 8))),
+    ({"type": "permesso", "permit_date": "2025-03-14", "start_time": "09:00", "end_time": "11:00"},
+     (datetime(2025, 3, 14), datetime(2025, 3, 14))),
+    ({"type": "malattia", "sick_start_date": "2025-12-30", "sick_days": 3},
+     (datetime(2025, 12, 30), datetime(2026, 1, 1))),
+    # A sick leave is at least one day
+    ({"type": "malattia", "sick_start_date": "2025-05-05", "sick_days": None},
+     (datetime(2025, 5, 5), datetime(2025, 5, 5))),
+    ({"type": "ferie", "start_date": "2025-08-04", "end_date": None}, (None, None)),
+    ({"type": "permesso"}, (None, None)),
+])
+def test_absence_range(request_doc, expected):
+    assert server.absence_range(request_doc) == expected
+
+
+def test_cross_year_ferie_counts_working_days_per_year():
+    # 25-26 Dec and 1 and 6 Jan are holidays
+    request_doc = {"type": "ferie", "start_date": "2025-12-22", "end_date": "2026-01-09"}
+    assert server.leave_days_by_year(request_doc) == [share(2025, ferie_days=6), share(2026, ferie_days=5)]
+
+
+def test_weekend_only_year_share_still_counts_the_request():
+    # Saturday 31 Dec 2022, then 1 Jan 2023 (Sunday, Capodanno) to Wednesday 4 Jan
+    request_doc = {"type": "ferie", "start_date": "2022-12-31", "end_date": "2023-01-04"}
+    assert server.leave_days_by_year(request_doc) == [share(2022, ferie_days=0), share(2023, ferie_days=3)]
+
+
+def test_malattia_spanning_new_year_counts_calendar_days():
+    request_doc = {"type": "malattia", "sick_start_date": "2024-12-30", "sick_days": 5}
+    assert server.leave_days_by_year(request_doc) == [share(2024, malattie_days=2), share(2025, malattie_days=3)]
+
+
+def test_permesso_belongs_to_the_year_of_its_date():
+    request_doc = {"type": "permesso", "permit_date": "2025-01-02", "created_at": datetime(2024, 12, 20)}
+    assert server.leave_days_by_year(request_doc) == [share(2025, permessi_count=1)]
+
+
+@pytest.mark.parametrize("request_doc", [
+    {"type": "permesso", "permit_date": None, "created_at": datetime(2023, 6, 1)},
+    {"type": "ferie", "start_date": "2023-06-05", "end_date": None, "created_at": datetime(2023, 6, 1)},
+])
+def test_dateless_request_falls_back_to_creation_year(request_doc):
+    assert server.leave_days_by_year(request_doc) == [share(2023)]
+
+
+@pytest.mark.parametrize("old_status,new_status,expected", [
+    ("pending", "approved", 1),
+    ("rejected", "approved", 1),
+    ("approved", "rejected", -1),
+    ("approved", "pending", -1),
+    ("approved", "approved", 0),
+    ("pending", "rejected", 0),
+    ("rejected", "rejected", 0),
+])
+def test_approval_sign(old_status, new_status, expected):
+    assert server.approval_sign(old_status, new_status) == expected
+
+
+def legacy_request(user_id: str, start: date, end: date) -> dict:
+    return {"id": str(uuid.uuid4()), "user_id": user_id, "type": "ferie", "status": "approved",
+            "start_date": start.isoformat(), "end_date": end.isoformat(), "created_at": datetime(2025, 1, 10)}
+
+
+async def run_boots() -> dict:
+    first = legacy_request("u1", date(2025, 12, 29), date(2026, 1, 2))
+    await server.db.requests.insert_one(dict(first))
+    await server.bootstrap_request_fields()
+    await server.bootstrap_yearly_stats()
+
+    # Written after the migration, e.g. by hand: the next boot does not scan for it
+    second = legacy_request("u1", date(2025, 3, 3), date(2025, 3, 3))
+    await server.db.requests.insert_one(dict(second))
+    await server.bootstrap_request_fields()
+
+    return {
+        "first": await server.db.requests.find_one({"id": first["id"]}),
+        "second": await server.db.requests.find_one({"id": second["id"]}),
+        "marker": await server.db.migrations.find_one({"_id": server.REQUEST_FIELDS_MIGRATION}),
+        "stats": {doc["year"]: doc["ferie_days"] async for doc in server.db.yearly_stats.find({"user_id": "u1"})},
+    }
+
+
+def test_request_fields_backfill_runs_once_before_the_stats(server_db):
+    result = asyncio.run(run_boots())
+
+    assert [item["year"] for item in result["first"]["days_by_year"]] == [2025, 2026]
+    assert result["marker"]["updated"] == 1
+    assert "days_by_year" not in result["second"]
+    # Built from the backfilled shares, not from the creation year
+    assert result["stats"] == {2025: 3, 2026: 1}
@@ -0,0 +1,59 @@
+"""
+Checks for the request metrics: Prometheus histogram rendering and the
+latency / DB-call accounting of RequestMetricsMiddleware.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import server
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = server.Histogram("test_seconds", "Test", ("route",), (0.1, 1.0))
+    histogram.observe(("/a",), 0.05)
+    histogram.observe(("/a",), 0.5)
+    histogram.observe(("/a",), 5)
+
+    lines = histogram.render()
+    assert "# TYPE test_seconds histogram" in lines
+    assert 'test_seconds_bucket{route="/a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{route="/a",le="1.0"} 2' in lines
+    assert 'test_seconds_bucket{route="/a",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{route="/a"} 3' in lines
+
+
+def test_histogram_escapes_label_values():
+    histogram = server.Histogram("test_seconds", "Test", ("route",), (1.0,))
+    histogram.observe(('/a"b',), 0.5)
+    assert 'test_seconds_count{route="/a\\"b"} 1' in histogram.render()
+
+
+def test_middleware_charges_db_calls_to_the_request():
+    route = SimpleNamespace(path="/api/test/{item_id}")
+
+    async def app(scope, receive, send):
+        scope["route"] = route
+        # Two commands seen by the listener while serving the request
+        listener = server.MongoCommandListener()
+        for _ in range(2):
+            listener.succeeded(SimpleNamespace(command_name="find", duration_micros=2000))
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    async def receive():
+        return {"type": "http.request"}
+
+    scope = {"type": "http", "method": "GET", "path": "/api/test/1"}
+    asyncio.run(server.RequestMetricsMiddleware(app)(scope, receive, send))
+
+    headers = dict(sent[0]["headers"])
+    assert headers[b"server-timing"].startswith(b'db;desc="2 calls";dur=4.0')
+    assert 'http_request_db_calls_count{method="GET",route="/api/test/{item_id}"} 1' in \
+        server.http_request_db_calls.render()
+    assert server.request_db_stats.get() is None
@@ -0,0 +1,27 @@
+"""
+Checks for the projection of GET /api/requests: internal bookkeeping fields
+stay out of the default listing and can only be requested when public.
+"""
+
+import pytest
+
+import server
+
+
+def test_default_listing_hides_internal_fields():
+    projection = server.build_requests_projection(None)
+    assert projection["_id"] == 0
+    assert {field for field, include in projection.items() if include == 0} == {"_id", *server.INTERNAL_REQUEST_FIELDS}
+
+
+def test_public_derived_fields_can_be_requested():
+    projection = server.build_requests_projection("type, working_days,coverage_conflicts")
+    assert projection == {"_id": 0, "id": 1, "user_id": 1, "created_at": 1,
+                          "type": 1, "working_days": 1, "coverage_conflicts": 1}
+
+
+@pytest.mark.parametrize("field", ["days_by_year", "absence_start", "response_id", "password_hash"])
+def test_internal_fields_are_rejected(field):
+    with pytest.raises(server.HTTPException) as error:
+        server.build_requests_projection(f"type,{field}")
+    assert error.value.status_code == 400
@@ -0,0 +1,119 @@
+"""
+Checks SMTPMailer against a local aiosmtpd server: messages share one SMTP
+session, a session dropped by the server is reopened transparently and a
+failed send never leaves its session open for the next message.
+"""
+
+import asyncio
+import socket
+
+import pytest
+from aiosmtpd.controller import Controller
+
+import server
+
+
+class RecordingHandler:
+    """Keeps, for each message received, the client address of its session"""
+    def __init__(self):
+        self.peers = []
+
+    async def handle_DATA(self, smtp_server, session, envelope):
+        self.peers.append(session.peer)
+        return "250 OK"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def smtp_port():
+    return free_port()
+
+
+def start_smtp(handler: RecordingHandler, port: int) -> Controller:
+    controller = Controller(handler, hostname="127.0.0.1", port=port)
+    controller.start()
+    return controller
+
+
+def message(index: int):
+    return server.build_email_message(f"dipendente{index}@company.com", f"Messaggio {index}", "Testo")
+
+
+def local_mailer(port: int) -> tuple:
+    """An SMTPMailer for the local server, and the list of connections it opens"""
+    settings = server.EmailSettings()
+    settings.smtp_server, settings.smtp_port, settings.smtp_use_tls = "127.0.0.1", port, False
+    settings.admin_email, settings.admin_password = "admin@company.com", ""
+    mailer = server.SMTPMailer(settings)
+    connections = []
+    connect = mailer._connect
+    mailer._connect = lambda: connections.append(1) or connect()
+    return mailer, connections
+
+
+def test_messages_share_a_session_and_survive_a_server_restart(smtp_port):
+    mailer, connections = local_mailer(smtp_port)
+
+    first_handler = RecordingHandler()
+    controller = start_smtp(first_handler, smtp_port)
+    try:
+        async def send_two():
+            await mailer.send(message(1))
+            await mailer.send(message(2))
+        asyncio.run(send_two())
+    finally:
+        controller.stop()
+
+    assert len(first_handler.peers) == 2
+    assert first_handler.peers[0] == first_handler.peers[1]
+    assert len(connections) == 1
+
+    # The open session died with the server: _send reconnects and retries once
+    second_handler = RecordingHandler()
+    controller = start_smtp(second_handler, smtp_port)
+    try:
+        async def send_after_restart():
+            await mailer.send(message(3))
+            await mailer.close()
+        asyncio.run(send_after_restart())
+    finally:
+        controller.stop()
+
+    assert len(second_handler.peers) == 1
+    assert len(connections) == 2
+    assert second_handler.peers[0] != first_handler.peers[0]
+
+
+class RejectingHandler(RecordingHandler):
+    """Rejects the first message it receives"""
+    async def handle_DATA(self, smtp_server, session, envelope):
+        if not self.peers:
+            self.peers.append(None)
+            return "554 Transaction failed"
+        return await super().handle_DATA(smtp_server, session, envelope)
+
+
+def test_failed_send_closes_the_session(smtp_port):
+    mailer, connections = local_mailer(smtp_port)
+
+    handler = RejectingHandler()
+    controller = start_smtp(handler, smtp_port)
+    try:
+        async def send_two():
+            with pytest.raises(server.smtplib.SMTPDataError):
+                await mailer.send(message(1))
+            assert mailer._server is None
+            await mailer.send(message(2))
+            await mailer.close()
+        asyncio.run(send_two())
+    finally:
+        controller.stop()
+
+    # The rejected message is not retried, the next one opens a new session
+    assert len(connections) == 2
+    assert len(handler.peers) == 2
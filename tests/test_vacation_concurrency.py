@@ -0,0 +1,239 @@
+"""
+Concurrency stress test for vacation allowance updates.
+
+Fires hundreds of parallel approvals (each one sent twice), rejections and
+vacation summaries through the route handlers of backend/server.py and
+checks that the final balances match a sequential computation. The other
+tests slip a recomputation or an edit into a single approval at the points
+where it used to be miscounted.
+"""
+
+import asyncio
+import uuid
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import server
+from work_calendar import is_working_day, working_days_between
+
+APPROVED_REQUESTS = 200
+REJECTED_AFTERWARDS = 50
+PARALLEL_SUMMARIES = 100
+PREVIOUS_YEAR_REMAINING = 200
+
+
+async def run_stress() -> dict:
+    year = datetime.utcnow().year
+
+    admin = server.User(username="admin", email="admin@company.com", password_hash="x", role="admin")
+    employee = server.User(username="mario.rossi", email="mario@company.com", password_hash="x")
+    await server.db.users.insert_many([admin.dict(), employee.dict()])
+
+    # Previous year balance to carry over, and an already opened following year
+    await server.db.vacation_allowances.insert_many([
+        {"id": str(uuid.uuid4()), "user_id": employee.id, "year": year - 1, "max_days": 20, "used_days": 0,
+         "carried_over_days": PREVIOUS_YEAR_REMAINING - 20, "remaining_days": PREVIOUS_YEAR_REMAINING, "version": 0},
+        {"id": str(uuid.uuid4()), "user_id": employee.id, "year": year + 1, "max_days": 20, "used_days": 0,
+         "carried_over_days": 0, "remaining_days": 20, "version": 0},
+    ])
+
+    # One working day per request
+    leave_days = [date(year, 1, 1) + timedelta(days=i) for i in range(366)]
+    leave_days = [day for day in leave_days if day.year == year and is_working_day(day)]
+    request_ids = []
+    for leave_day in leave_days[:APPROVED_REQUESTS]:
+        request_ids.append(str(uuid.uuid4()))
+        request_doc = {
+            "id": request_ids[-1], "user_id": employee.id, "type": "ferie", "status": "pending",
+            "start_date": leave_day.isoformat(), "end_date": leave_day.isoformat(), "created_at": datetime.utcnow()
+        }
+        request_doc.update(server.derived_request_fields(request_doc))
+        await server.db.requests.insert_one(request_doc)
+
+    def respond(request_id: str, action: str):
+        return server.respond_to_request(
+            request_id, server.AdminResponse(request_id=request_id, action=action), current_user=admin
+        )
+
+    # Every approval is sent twice, interleaved with summary page loads
+    await asyncio.gather(
+        *[respond(request_id, "approve") for request_id in request_ids for _ in range(2)],
+        *[server.get_personal_vacation_summary(current_user=employee) for _ in range(PARALLEL_SUMMARIES)]
+    )
+    await asyncio.gather(*[respond(request_id, "reject") for request_id in request_ids[:REJECTED_AFTERWARDS]])
+
+    allowances = await server.db.vacation_allowances.find({"user_id": employee.id}).to_list(None)
+    return {
+        "year": year,
+        "allowances": {a['year']: a for a in allowances},
+        "current_year_count": sum(1 for a in allowances if a['year'] == year),
+        "debits": await server.db.vacation_ledger.count_documents({"kind": "debit"}),
+        "credits": await server.db.vacation_ledger.count_documents({"kind": "credit"}),
+        "stats": await server.get_yearly_stats(employee.id, year),
+    }
+
+
+def test_concurrent_approvals_keep_balances_consistent(server_db):
+    result = asyncio.run(run_stress())
+    year = result["year"]
+    used_days = APPROVED_REQUESTS - REJECTED_AFTERWARDS
+
+    assert result["current_year_count"] == 1
+
+    current = result["allowances"][year]
+    assert current["used_days"] == used_days
+    assert current["carried_over_days"] == PREVIOUS_YEAR_REMAINING
+    assert current["remaining_days"] == 20 + PREVIOUS_YEAR_REMAINING - used_days
+
+    following = result["allowances"][year + 1]
+    assert following["carried_over_days"] == max(0, current["remaining_days"])
+    assert following["remaining_days"] == 20 + following["carried_over_days"]
+
+    assert result["debits"] == APPROVED_REQUESTS
+    assert result["credits"] == REJECTED_AFTERWARDS
+    assert result["stats"].ferie_days == used_days
+
+
+async def run_edit_race() -> dict:
+    original_find_conflicts = server.find_request_conflicts
+    try:
+        admin = server.User(username="admin", email="admin@company.com", password_hash="x", role="admin")
+        employee = server.User(username="luigi.verdi", email="luigi@company.com", password_hash="x")
+        await server.db.users.insert_many([admin.dict(), employee.dict()])
+
+        year = datetime.utcnow().year
+        request_data = server.LeaveRequestCreate(type="ferie", start_date=date(year, 7, 6), end_date=date(year, 7, 8))
+        request_id = (await server.create_request(request_data, current_user=employee))["request_id"]
+
+        # The admin approves after the employee's edit has read the request as pending
+        async def approve_first(*args, **kwargs):
+            await server.respond_to_request(
+                request_id, server.AdminResponse(request_id=request_id, action="approve"), current_user=admin
+            )
+            return await original_find_conflicts(*args, **kwargs)
+
+        server.find_request_conflicts = approve_first
+        try:
+            await server.update_request(request_id, request_data, current_user=employee)
+            edit_status = 200
+        except server.HTTPException as e:
+            edit_status = e.status_code
+        server.find_request_conflicts = original_find_conflicts
+
+        return {
+            "edit_status": edit_status,
+            "status": (await server.db.requests.find_one({"id": request_id}))["status"],
+            "stats": await server.get_yearly_stats(employee.id, year),
+            "working_days": working_days_between(date(year, 7, 6), date(year, 7, 8)),
+        }
+    finally:
+        server.find_request_conflicts = original_find_conflicts
+
+
+def test_edit_racing_an_approval_does_not_reopen_it(server_db):
+    result = asyncio.run(run_edit_race())
+
+    assert result["edit_status"] == 400
+    assert result["status"] == "approved"
+    assert result["stats"].ferie_days == result["working_days"]
+
+
+async def run_recompute_race(hook: str) -> dict:
+    """Approve one ferie request with a recomputation slipped in at the given point"""
+    admin = server.User(username="admin", email="admin@company.com", password_hash="x", role="admin")
+    employee = server.User(username="anna.neri", email="anna@company.com", password_hash="x")
+    await server.db.users.insert_many([admin.dict(), employee.dict()])
+
+    year = datetime.utcnow().year
+    request_data = server.LeaveRequestCreate(type="ferie", start_date=date(year, 9, 7), end_date=date(year, 9, 11))
+    request_id = (await server.create_request(request_data, current_user=employee))["request_id"]
+    await server.get_or_create_vacation_allowance(employee.id, year)
+
+    original = getattr(server, hook)
+
+    async def recompute_first(*args, **kwargs):
+        if hook == "ensure_vacation_allowances":
+            # The allowance changes after its version was read, before the status swap
+            versions = await original(*args, **kwargs)
+            await server.recompute_vacation_allowances(employee.id, year, max_days=25)
+            return versions
+        # The status is already swapped, the ledger has not run yet
+        await server.recompute_vacation_allowances(employee.id, year)
+        return await original(*args, **kwargs)
+
+    setattr(server, hook, recompute_first)
+    try:
+        await server.respond_to_request(
+            request_id, server.AdminResponse(request_id=request_id, action="approve"), current_user=admin
+        )
+    finally:
+        setattr(server, hook, original)
+
+    return {
+        "allowance": await server.db.vacation_allowances.find_one({"user_id": employee.id, "year": year}),
+        "working_days": working_days_between(date(year, 9, 7), date(year, 9, 11)),
+    }
+
+
+def test_recompute_between_swap_and_ledger_counts_approval_once(server_db):
+    result = asyncio.run(run_recompute_race("update_absence_headcount_on_status_changes"))
+    allowance = result["allowance"]
+
+    assert allowance["used_days"] == result["working_days"]
+    assert allowance["remaining_days"] == allowance["max_days"] + allowance["carried_over_days"] - result["working_days"]
+
+
+def test_allowance_change_before_swap_still_counts_approval(server_db):
+    result = asyncio.run(run_recompute_race("ensure_vacation_allowances"))
+    allowance = result["allowance"]
+
+    assert allowance["max_days"] == 25
+    assert allowance["used_days"] == result["working_days"]
+    assert allowance["remaining_days"] == 25 + allowance["carried_over_days"] - result["working_days"]
+
+
+async def run_approval_after_edit(bulk: bool) -> dict:
+    admin = server.User(username="admin", email="admin@company.com", password_hash="x", role="admin")
+    employee = server.User(username="paolo.gialli", email="paolo@company.com", password_hash="x")
+    await server.db.users.insert_many([admin.dict(), employee.dict()])
+
+    year = datetime.utcnow().year
+    request_data = server.LeaveRequestCreate(type="ferie", start_date=date(year, 9, 7), end_date=date(year, 9, 11))
+    request_id = (await server.create_request(request_data, current_user=employee))["request_id"]
+    edited_data = server.LeaveRequestCreate(type="ferie", start_date=date(year, 9, 7), end_date=date(year, 9, 8))
+
+    # The employee shortens the request after the admin's handler has read it
+    original_ensure = server.ensure_vacation_allowances
+
+    async def edit_first(*args, **kwargs):
+        versions = await original_ensure(*args, **kwargs)
+        await server.update_request(request_id, edited_data, current_user=employee)
+        return versions
+
+    server.ensure_vacation_allowances = edit_first
+    try:
+        if bulk:
+            await server.bulk_respond_to_requests(
+                server.BulkAdminResponse(request_ids=[request_id], action="approve"), current_user=admin
+            )
+        else:
+            await server.respond_to_request(
+                request_id, server.AdminResponse(request_id=request_id, action="approve"), current_user=admin
+            )
+    finally:
+        server.ensure_vacation_allowances = original_ensure
+
+    return {
+        "stats": await server.get_yearly_stats(employee.id, year),
+        "allowance": await server.db.vacation_allowances.find_one({"user_id": employee.id, "year": year}),
+        "working_days": working_days_between(date(year, 9, 7), date(year, 9, 8)),
+    }
+
+
+@pytest.mark.parametrize("bulk", [False, True])
+def test_approval_counts_dates_edited_before_the_swap(server_db, bulk):
+    result = asyncio.run(run_approval_after_edit(bulk))
+
+    assert result["stats"].ferie_days == result["working_days"]
+    assert result["allowance"]["used_days"] == result["working_days"]
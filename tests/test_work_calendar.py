@@ -0,0 +1,53 @@
+"""
+Checks for the Italian working-day calendar used to count vacation days.
+"""
+
+from datetime import date, timedelta
+
+import pytest
+
+from work_calendar import easter_sunday, is_working_day, public_holidays, working_days_between
+
+
+@pytest.mark.parametrize("year,expected", [
+    (2024, date(2024, 3, 31)),
+    (2025, date(2025, 4, 20)),
+    (2026, date(2026, 4, 5)),
+    (2038, date(2038, 4, 25)),
+])
+def test_easter_sunday(year, expected):
+    assert easter_sunday(year) == expected
+
+
+def test_public_holidays_include_easter_monday():
+    holidays = public_holidays(2025)
+    assert len(holidays) == 11
+    assert date(2025, 4, 21) in holidays
+    assert date(2025, 6, 2) in holidays
+
+
+@pytest.mark.parametrize("start,end,expected", [
+    # Monday to Friday
+    (date(2025, 9, 1), date(2025, 9, 5), 5),
+    # Two full weeks
+    (date(2025, 9, 1), date(2025, 9, 14), 10),
+    # Weekend only
+    (date(2025, 9, 6), date(2025, 9, 7), 0),
+    # Ferragosto falls on a Friday
+    (date(2025, 8, 11), date(2025, 8, 17), 4),
+    # Easter Monday
+    (date(2025, 4, 21), date(2025, 4, 25), 3),
+    # Across the new year: 29-31 Dec, 2 Jan (1 Jan is a holiday)
+    (date(2025, 12, 27), date(2026, 1, 4), 4),
+    (date(2025, 9, 5), date(2025, 9, 1), 0),
+])
+def test_working_days_between(start, end, expected):
+    assert working_days_between(start, end) == expected
+
+
+def test_working_days_between_matches_day_by_day_count():
+    start = date(2023, 11, 15)
+    for length in range(0, 500, 7):
+        end = start + timedelta(days=length)
+        expected = sum(is_working_day(start + timedelta(days=i)) for i in range(length + 1))
+        assert working_days_between(start, end) == expected